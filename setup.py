@@ -17,7 +17,12 @@ setup(
         "argcomplete",
         "conda-build>=3.18.10",
         "ruamel.yaml>=0.15.2",
+        "ruamel.yaml.clib",
     ],
+    extras_require={
+        # faster parsing of the `conda search` output
+        "fast": ["orjson"],
+    },
     entry_points={
         "console_scripts": ["publish-conda-stack = publish_conda_stack.__main__:main"]
     },
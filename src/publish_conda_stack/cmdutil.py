@@ -1,10 +1,15 @@
+import importlib.util
+import shutil
 from enum import IntEnum, auto
-from typing import List
+from typing import Callable, Dict, List
 
 from .util import labels_to_search_args
 
 DEFAULT_BACKEND = "conda"
 
+_RENDER_FLAGS = ("render", "--output")
+_SEARCH_FLAGS = ("search", "--json", "--full-name", "--override-channels", "--channel")
+
 
 class CondaCommand(IntEnum):
     RENDER: int = auto()
@@ -12,48 +17,72 @@ class CondaCommand(IntEnum):
     BUILD: int = auto()
 
 
-def conda_cmd_base(command: CondaCommand, shared_config: dict) -> List[str]:
-    variant_config = shared_config.get("master-conda-build-config", None)
-    variant_args = ["-m", variant_config] if variant_config else []
+def default_backend() -> str:
+    """
+    The backend to use if none is configured: mamba if it is installed
+    together with boa (which provides `conda mambabuild`), conda otherwise.
+    """
+    if shutil.which("mamba") and importlib.util.find_spec("boa") is not None:
+        return "mamba"
+    return DEFAULT_BACKEND
 
-    # render is not supported in mamba, here we must use conda
-    if command == CondaCommand.RENDER:
-        args = ["conda"]
-        args.extend(["render", "--output"])
-        args.extend(shared_config["conda-source-channel-list"])
-        args.extend(variant_args)
-        return args
 
+def _backend(shared_config: dict) -> str:
     backend = shared_config.get("backend", DEFAULT_BACKEND)
     if backend not in ["conda", "mamba"]:
         raise ValueError(
             f"Unknown backend: {backend}. Only `conda` and `mamba` are supported."
         )
+    return backend
 
-    args = [backend]
-
-    if command == CondaCommand.SEARCH:
-        labels = shared_config.get("labels", [])
-        args.extend(
-            [
-                "search",
-                "--json",
-                "--full-name",
-                "--override-channels",
-                "--channel",
-                shared_config["upload-channel"],
-            ]
-        )
-        args.extend(labels_to_search_args(shared_config["upload-channel"], labels))
-        return args
-
-    if command == CondaCommand.BUILD:
-        if backend == "mamba":
-            args = ["conda", "mambabuild"]
-        else:
-            args.extend(["build"])
-        args.extend(shared_config["conda-source-channel-list"])
-        args.extend(variant_args)
-        return args
-
-    raise ValueError(f"unknown command supplied. Got {command}")
+
+def _variant_args(shared_config: dict) -> List[str]:
+    variant_config = shared_config.get("master-conda-build-config", None)
+    return ["-m", variant_config] if variant_config else []
+
+
+def _render_args(shared_config: dict) -> List[str]:
+    # render is not supported in mamba, here we must use conda
+    return [
+        "conda",
+        *_RENDER_FLAGS,
+        *shared_config["conda-source-channel-list"],
+        *_variant_args(shared_config),
+    ]
+
+
+def _search_args(shared_config: dict) -> List[str]:
+    upload_channel = shared_config["upload-channel"]
+    labels = shared_config.get("labels", [])
+    return [
+        _backend(shared_config),
+        *_SEARCH_FLAGS,
+        upload_channel,
+        *labels_to_search_args(upload_channel, labels),
+    ]
+
+
+def _build_args(shared_config: dict) -> List[str]:
+    backend = _backend(shared_config)
+    # mamba builds go through boa's `conda mambabuild`
+    prefix = ("conda", "mambabuild") if backend == "mamba" else (backend, "build")
+    return [
+        *prefix,
+        *shared_config["conda-source-channel-list"],
+        *_variant_args(shared_config),
+    ]
+
+
+_COMMAND_ARGS: Dict[CondaCommand, Callable[[dict], List[str]]] = {
+    CondaCommand.RENDER: _render_args,
+    CondaCommand.SEARCH: _search_args,
+    CondaCommand.BUILD: _build_args,
+}
+
+
+def conda_cmd_base(command: CondaCommand, shared_config: dict) -> List[str]:
+    try:
+        command_args = _COMMAND_ARGS[command]
+    except KeyError:
+        raise ValueError(f"unknown command supplied. Got {command}")
+    return command_args(shared_config)
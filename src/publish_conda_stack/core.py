@@ -2,44 +2,110 @@
 # PYTHON_ARGCOMPLETE_OK
 import argparse
 import datetime
-import json
+import hashlib
 import logging
 import os
+import re
+import shlex
 import subprocess
 import sys
+import threading
 import time
-from collections import namedtuple
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import lru_cache
+from graphlib import CycleError, TopologicalSorter
 from itertools import chain
-from os.path import abspath, basename, dirname, exists, isabs, normpath, splitext
+from os.path import abspath, basename, exists, splitext
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
-import conda_build.api
 from ruamel.yaml import YAML
+from ruamel.yaml.events import (
+    AliasEvent,
+    CollectionEndEvent,
+    CollectionStartEvent,
+    MappingEndEvent,
+    MappingStartEvent,
+    ScalarEvent,
+    SequenceEndEvent,
+    SequenceStartEvent,
+)
 
 from . import __version__
-from .cmdutil import CondaCommand, conda_cmd_base
-from .util import labels_to_upload_string, strip_label
+from .cmdutil import CondaCommand, conda_cmd_base, default_backend
+from .util import labels_to_upload_args, strip_label
+
+if TYPE_CHECKING:
+    # conda_build.api is expensive to import, and not needed for --list or
+    # tab-completion. It is imported on demand in main().
+    import conda_build.api
 
 logger = logging.getLogger()
 logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
 
-try:
-    import argcomplete
-    from argcomplete.completers import FilesCompleter
+# argcomplete runs the whole program on every <TAB>, only import it when the
+# shell is actually asking for completions.
+ENABLE_TAB_COMPLETION = False
+if "_ARGCOMPLETE" in os.environ:
+    try:
+        import argcomplete
+        from argcomplete.completers import FilesCompleter
 
-    ENABLE_TAB_COMPLETION = True
-except Exception as e:
-    # See --help text for instructions.
-    ENABLE_TAB_COMPLETION = False
-    logger.debug(f"Tab completion not available: {e}")
+        ENABLE_TAB_COMPLETION = True
+    except Exception as e:
+        # See --help text for instructions.
+        logger.debug(f"Tab completion not available: {e}")
+
+# orjson parses the (large) `conda search --json` output a lot faster.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 # Disable git pager for log messages, etc.
 os.environ["GIT_PAGER"] = ""
 
+
+# file name extensions of conda packages, in both the old and the new format
+PACKAGE_EXTENSIONS = (".tar.bz2", ".conda")
+
+
 # Canonical Conda Package Name
-CCPkgName = namedtuple("CCPkgName", ["package_name", "version", "build_string"])
+class CCPkgName(NamedTuple):
+    package_name: str
+    version: str
+    build_string: str
+    # package format, as rendered
+    extension: str = ".tar.bz2"
+
+    @property
+    def file_name(self) -> str:
+        return f"{self.package_name}-{self.version}-{self.build_string}{self.extension}"
+
+
+@lru_cache(maxsize=None)
+def safe_yaml() -> YAML:
+    """
+    ruamel's safe loader/dumper, backed by the libyaml C bindings
+    (ruamel.yaml.clib) if they are installed, pure Python otherwise.
+
+    Shared by all callers, so it is only set up once per process.
+    """
+    yaml = YAML(typ="safe", pure=False)
+    yaml.default_flow_style = False
+    return yaml
 
 
 def parse_cmdline_args():
@@ -72,6 +138,24 @@ def parse_cmdline_args():
         default=os.environ.get("PUBLISH_START_FROM", ""),
         help="Recipe name to start from building recipe specs in YAML file.",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=int(os.environ.get("PUBLISH_JOBS", 4)),
+        help=(
+            "Number of recipes to process in parallel. "
+            "Recipes are only started once the recipes they depend on are done."
+        ),
+    )
+    parser.add_argument(
+        "--no-search-cache",
+        action="store_true",
+        help=(
+            "Search the destination channel for the packages of each recipe "
+            "separately, instead of listing the whole channel once up front."
+        ),
+    )
     parser.add_argument(
         "--label",
         action="append",
@@ -92,11 +176,8 @@ def parse_cmdline_args():
     if ENABLE_TAB_COMPLETION:
 
         def complete_recipe_selection(prefix, action, parser, parsed_args):
-            yaml = YAML(typ="safe")
-            specs_file_contents = yaml.load(open(parsed_args.recipe_specs_path, "r"))
-            recipe_specs = specs_file_contents["recipe-specs"]
-            names = (spec["name"] for spec in recipe_specs)
-            return filter(lambda name: name.startswith(prefix), names)
+            names = load_recipe_names(parsed_args.recipe_specs_path)
+            return [name for name in names if name.startswith(prefix)]
 
         specs_path_arg.completer = FilesCompleter((".yml", ".yaml"), directories=False)
         selection_arg.completer = complete_recipe_selection
@@ -106,11 +187,150 @@ def parse_cmdline_args():
     return args
 
 
+def _skip_node(events, first_event):
+    """
+    Consume the events of the YAML node that starts with first_event.
+    """
+    depth = 1 if isinstance(first_event, CollectionStartEvent) else 0
+    while depth:
+        event = next(events)
+        if isinstance(event, CollectionStartEvent):
+            depth += 1
+        elif isinstance(event, CollectionEndEvent):
+            depth -= 1
+
+
+def iter_recipe_names(stream) -> Iterator[str]:
+    """
+    Yield the name of each entry in the recipe-specs section of the given
+    specs file stream.
+
+    Only walks the parser events: none of the (possibly large) specs are
+    constructed, everything apart from the names is skipped. Aliases
+    (e.g. ``name: *base-name`` or ``<<: *base-spec``) can't be resolved
+    that way, if recipe-specs uses them the whole file is loaded instead.
+    """
+    text = stream if isinstance(stream, str) else stream.read()
+    events = safe_yaml().parse(text)
+    try:
+        names = list(_scan_recipe_names(events))
+    finally:
+        # Finish with the parser even if we stopped early, before load() below
+        events.close()
+    if None in names:
+        specs = safe_yaml().load(text) or {}
+        names = [
+            spec["name"]
+            for spec in specs.get("recipe-specs") or []
+            if isinstance(spec, dict) and "name" in spec
+        ]
+    yield from names
+
+
+def _scan_recipe_names(events) -> Iterator[Optional[str]]:
+    """
+    Event walker behind iter_recipe_names. Yields None if it runs into an
+    alias that could provide a recipe name.
+    """
+    for event in events:
+        if isinstance(event, MappingStartEvent):
+            break
+    else:
+        return
+
+    # top-level mapping
+    for key in events:
+        if isinstance(key, MappingEndEvent):
+            return
+        _skip_node(events, key)
+        value = next(events)
+        is_recipe_specs = isinstance(key, ScalarEvent) and key.value == "recipe-specs"
+        if is_recipe_specs and isinstance(value, AliasEvent):
+            yield None
+            return
+        if not (is_recipe_specs and isinstance(value, SequenceStartEvent)):
+            _skip_node(events, value)
+            continue
+
+        for spec in events:
+            if isinstance(spec, SequenceEndEvent):
+                return
+            if isinstance(spec, AliasEvent):
+                yield None
+                return
+            if not isinstance(spec, MappingStartEvent):
+                _skip_node(events, spec)
+                continue
+
+            for spec_key in events:
+                if isinstance(spec_key, MappingEndEvent):
+                    break
+                _skip_node(events, spec_key)
+                spec_value = next(events)
+                key_value = (
+                    spec_key.value if isinstance(spec_key, ScalarEvent) else None
+                )
+                if key_value == "<<" or (
+                    key_value == "name" and isinstance(spec_value, AliasEvent)
+                ):
+                    yield None
+                    return
+                if key_value == "name" and isinstance(spec_value, ScalarEvent):
+                    yield spec_value.value
+                else:
+                    _skip_node(events, spec_value)
+
+
+def recipe_names_cache_path(recipe_specs_path) -> Path:
+    """
+    Location of the on-disk recipe name cache for the given specs file.
+    Kept in the user's cache directory, so we don't litter the recipes repo.
+    """
+    cache_home = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    key = hashlib.sha1(abspath(recipe_specs_path).encode()).hexdigest()
+    return cache_home / "publish-conda-stack" / f"{key}.names"
+
+
+def load_recipe_names(recipe_specs_path) -> List[str]:
+    """
+    Return the recipe names listed in the given specs file.
+
+    Used for tab-completion, which runs on every <TAB> press: the names are
+    cached on disk and reused as long as the specs file is not modified.
+    """
+    cache = recipe_names_cache_path(recipe_specs_path)
+    # The cache is valid for exactly this version of the specs file. Comparing
+    # against the cache's own mtime would miss specs files replaced by an older
+    # copy, or modified within the filesystem's timestamp resolution.
+    specs_stat = os.stat(recipe_specs_path)
+    cache_key = f"{specs_stat.st_mtime_ns} {specs_stat.st_size}"
+    try:
+        cached_key, *cached_names = cache.read_text().splitlines()
+        if cached_key == cache_key:
+            return cached_names
+    except (OSError, ValueError):
+        pass
+
+    with open(recipe_specs_path, "r") as f:
+        names = list(iter_recipe_names(f))
+
+    try:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        tmp_cache = cache.with_suffix(f".{os.getpid()}.tmp")
+        tmp_cache.write_text("\n".join([cache_key, *names]))
+        os.replace(tmp_cache, cache)
+    except OSError as e:
+        logger.debug(f"Could not write recipe name cache {cache}: {e}")
+
+    return names
+
+
 def parse_specs(args):
 
-    specs_dir = Path(dirname(abspath(args.recipe_specs_path)))
-    yaml = YAML(typ="safe")
-    specs_file_contents = yaml.load(open(args.recipe_specs_path, "r"))
+    specs_path = Path(args.recipe_specs_path)
+    specs_dir = specs_path.absolute().parent
+    # read in one go, as bytes, so libyaml detects the encoding itself
+    specs_file_contents = safe_yaml().load(specs_path.read_bytes())
 
     # Read the 'shared-config' section
     shared_config = specs_file_contents["shared-config"]
@@ -130,42 +350,48 @@ def parse_specs(args):
 
     # Overwrite repo-cache-dir with an absolute path
     # Path is given relative to the specs file directory.
-    if not shared_config["repo-cache-dir"].startswith("/"):
-        shared_config["repo-cache-dir"] = Path(
-            normpath(specs_dir / shared_config["repo-cache-dir"])
-        )
-
-    os.makedirs(shared_config["repo-cache-dir"], exist_ok=True)
-
-    selected_recipe_specs = get_selected_specs(
-        args, specs_file_contents["recipe-specs"]
-    )
+    repo_cache_dir = Path(shared_config["repo-cache-dir"])
+    if not repo_cache_dir.is_absolute():
+        repo_cache_dir = (specs_dir / repo_cache_dir).resolve()
+    shared_config["repo-cache-dir"] = repo_cache_dir
+    repo_cache_dir.mkdir(parents=True, exist_ok=True)
+
+    full_recipe_specs = specs_file_contents["recipe-specs"]
+    check_recipe_requires(full_recipe_specs)
+    selected_recipe_specs = get_selected_specs(args, full_recipe_specs)
+    for spec in selected_recipe_specs:
+        try:
+            split_build_flags(spec.get("conda-build-flags", ""))
+        except ValueError as e:
+            sys.exit(f"Invalid conda-build-flags for recipe {spec['name']}: {e}")
 
     # Optional master_conda_build_config
     if (
         "master-conda-build-config" in shared_config
         and shared_config["master-conda-build-config"] != ""
     ):
-        master_conda_build_config = shared_config["master-conda-build-config"]
+        master_conda_build_config = Path(shared_config["master-conda-build-config"])
 
         # make path to config file absolute (relative to specs file directory):
-        if not isabs(master_conda_build_config):
-            shared_config["master-conda-build-config"] = str(
+        if not master_conda_build_config.is_absolute():
+            master_conda_build_config = (
                 specs_dir / master_conda_build_config
-            )
+            ).resolve()
+        shared_config["master-conda-build-config"] = str(master_conda_build_config)
     else:
         shared_config["master-conda-build-config"] = None
 
-    shared_config["labels"] = args.label
+    labels = list(args.label)
 
     destination_channel, label = strip_label(shared_config["destination-channel"])
     if label is not None:
-        if label not in shared_config["labels"]:
-            shared_config["labels"].append(label)
+        if label not in labels:
+            labels.append(label)
+    shared_config["labels"] = tuple(labels)
     shared_config["upload-channel"] = destination_channel
 
     if "backend" not in shared_config:
-        shared_config["backend"] = "conda"
+        shared_config["backend"] = default_backend()
 
     shared_config["backend"] = shared_config["backend"].lower()
     if shared_config["backend"] not in ["conda", "mamba"]:
@@ -177,10 +403,7 @@ def parse_specs(args):
         f"Using `{shared_config['backend']}` backend. Can be set in config file under the 'backend' key."
     )
 
-    if args.token != "":
-        shared_config["token-string"] = f"-t {args.token}"
-    else:
-        shared_config["token-string"] = ""
+    shared_config["token"] = args.token
 
     return shared_config, selected_recipe_specs
 
@@ -188,14 +411,16 @@ def parse_specs(args):
 def main():
     start_time = datetime.datetime.now()
     args = parse_cmdline_args()
-    conda_bld_config = conda_build.api.get_or_merge_config(conda_build.api.Config())
-
     shared_config, selected_recipe_specs = parse_specs(args)
 
     if args.list:
         print_recipe_list(selected_recipe_specs)
         sys.exit(0)
 
+    import conda_build.api
+
+    conda_bld_config = conda_build.api.get_or_merge_config(conda_build.api.Config())
+
     tmp_args = vars(args)
     tmp_args["token"] = "nope"
     result = {
@@ -217,49 +442,236 @@ def main():
         result_file = os.path.abspath(args.logfile)
     else:
         result_file = os.path.abspath(default_outname)
+    # the full result is only written at the end, until then progress is
+    # appended here one recipe at a time
+    progress_file = f"{result_file}.progress"
 
-    for spec in selected_recipe_specs:
+    dependency_graph = recipe_dependency_graph(selected_recipe_specs)
+    dependency_graph.prepare()
+    try:
         try:
-            status = build_and_upload_recipe(spec, shared_config, conda_bld_config)
+            existing_packages = (
+                None if args.no_search_cache else search_channel(shared_config)
+            )
         except Exception as e:
-            result["errors"].append({"spec": spec, "error": e})
-            write_result(result_file, result)
-            raise e
-
-        for k, v in status.items():
-            result[k].append(v)
+            result["errors"].append({"error": repr(e)})
+            raise
+
+        with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+            running = {}
+            failure = None
+            while running or (failure is None and dependency_graph.is_active()):
+                if failure is None:
+                    for spec_index in dependency_graph.get_ready():
+                        future = pool.submit(
+                            build_and_upload_recipe,
+                            selected_recipe_specs[spec_index],
+                            shared_config,
+                            conda_bld_config,
+                            existing_packages,
+                        )
+                        running[future] = spec_index
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    spec_index = running.pop(future)
+                    spec = selected_recipe_specs[spec_index]
+                    try:
+                        status = future.result()
+                    except BaseException as e:
+                        # failed builds end in sys.exit(), i.e. SystemExit
+                        result["errors"].append({"spec": spec, "error": repr(e)})
+                        if failure is None:
+                            failure = e
+                            # Don't start anything new, but let the recipes
+                            # that are already being built finish.
+                            for pending in list(running):
+                                if pending.cancel():
+                                    del running[pending]
+                        continue
+
+                    for k, v in status.items():
+                        result[k].append(v)
+                    append_progress(progress_file, status)
+                    dependency_graph.done(spec_index)
+
+        if failure is not None:
+            raise failure
+    finally:
+        # Whether we are done or failed, leave the full result behind
+        end_time = datetime.datetime.now()
+        result["end_time"] = end_time.isoformat(timespec="seconds")
+        result["duration"] = str(end_time - start_time)
         write_result(result_file, result)
+        if os.path.exists(progress_file):
+            os.remove(progress_file)
 
-    end_time = datetime.datetime.now()
-    result["end_time"] = end_time.isoformat(timespec="seconds")
-    result["duration"] = str(end_time - start_time)
-    write_result(result_file, result)
-
-    yaml = YAML(typ="safe")
-    yaml.default_flow_style = False
     print("--------")
     print(f"DONE, Result written to {result_file}")
     print("--------")
     print("Summary:")
-    yaml.dump(result, sys.stdout)
+    safe_yaml().dump(result, sys.stdout)
 
 
 def write_result(result_file_name, result):
     result["last_updated"] = datetime.datetime.now().isoformat(timespec="seconds")
-    yaml = YAML(typ="safe")
-    yaml.default_flow_style = False
-    with open(result_file_name, "w") as f:
-        yaml.dump(result, f)
+    # Never leave a truncated result file behind if we crash while writing
+    tmp_file_name = f"{result_file_name}.tmp"
+    try:
+        with open(tmp_file_name, "w") as f:
+            safe_yaml().dump(result, f)
+        os.replace(tmp_file_name, result_file_name)
+    except BaseException:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
+
+
+def append_progress(progress_file_name, status):
+    """
+    Append the status of a single recipe to the progress file, as a YAML
+    document of its own. Unlike write_result, this doesn't re-serialize
+    everything that was done before.
+    """
+    status = {
+        **status,
+        "last_updated": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    with open(progress_file_name, "a") as f:
+        f.write("---\n")
+        safe_yaml().dump(status, f)
 
 
 def print_recipe_list(recipe_specs):
-    max_name = max(len(spec["name"]) for spec in recipe_specs)
-    for spec in recipe_specs:
-        logger.info(
-            f"{spec['name']: <{max_name}} : {spec['recipe-repo']} ({spec['tag']})"
+    if not recipe_specs or not logger.isEnabledFor(logging.INFO):
+        return
+
+    max_name = max(map(len, (spec["name"] for spec in recipe_specs)))
+    # A single (multi-line) record, the header keeps the lines aligned
+    # despite the log level prefix.
+    lines = (
+        f"{spec['name']: <{max_name}} : {spec['recipe-repo']} ({spec['tag']})"
+        for spec in recipe_specs
+    )
+    logger.info("\n".join(["Recipes:", *lines]))
+
+
+def recipe_dependency_graph(recipe_specs) -> TopologicalSorter:
+    """
+    Build the dependency graph of the given recipe specs.
+    Nodes are indices into recipe_specs.
+
+    A spec with a `requires` list only depends on the listed recipes, as far as
+    they are part of recipe_specs (others were not selected, and are assumed to
+    be published already, see check_recipe_requires).
+    A spec without `requires` depends on every spec listed before it, i.e. it is
+    processed in file order.
+    """
+    indices_by_name = defaultdict(list)
+    for spec_index, spec in enumerate(recipe_specs):
+        indices_by_name[spec["name"]].append(spec_index)
+
+    graph: TopologicalSorter = TopologicalSorter()
+    # Every spec before the last spec without `requires` is (transitively) a
+    # dependency of it, so later specs only need to depend on what follows it.
+    barrier = 0
+    for spec_index, spec in enumerate(recipe_specs):
+        dependencies: Iterable[int]
+        if "requires" in spec:
+            assert isinstance(spec["requires"], list)
+            dependencies = chain.from_iterable(
+                indices_by_name[name] for name in spec["requires"]
+            )
+        else:
+            dependencies = range(barrier, spec_index)
+            barrier = spec_index
+        graph.add(spec_index, *dependencies)
+
+    return graph
+
+
+def check_recipe_requires(recipe_specs):
+    """
+    Exit if a recipe requires a recipe that isn't listed in recipe_specs
+    (e.g. a typo), or if the recipes require each other in a cycle.
+    """
+    names = {spec["name"] for spec in recipe_specs}
+    unknown = [
+        f"{spec['name']} requires {name}"
+        for spec in recipe_specs
+        for name in spec.get("requires", [])
+        if name not in names
+    ]
+    if unknown:
+        sys.exit(f"Invalid requires, unknown recipes: {', '.join(unknown)}")
+
+    try:
+        recipe_dependency_graph(recipe_specs).prepare()
+    except CycleError as e:
+        cycle = [recipe_specs[spec_index]["name"] for spec_index in e.args[1]]
+        sys.exit(
+            f"Invalid requires, circular dependency between recipes: {' -> '.join(cycle)}"
         )
 
 
+class RepoCheckout:
+    """
+    The cached checkout of a recipe repo, shared by the recipes from that repo.
+
+    Any number of recipes can use the checkout concurrently as long as they
+    need the same tag. Checking out another tag waits until they are done.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._users = 0
+        # (recipe_repo, tag) currently checked out, and where
+        self._checked_out = None
+        self._repo_dir = None
+
+    @contextmanager
+    def use(self, recipe_repo, tag, cwd) -> Iterator[str]:
+        """
+        Check out recipe_repo at tag into the directory cwd (unless it already
+        is) and provide the checkout directory while the context is active.
+        """
+        wanted = (recipe_repo, tag)
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._users == 0 or self._checked_out == wanted
+            )
+            if self._checked_out == wanted:
+                logger.info(f"Using existing checkout of {tag} in {self._repo_dir}")
+            else:
+                self._checked_out = None
+                self._repo_dir = checkout_recipe_repo(recipe_repo, tag, cwd)
+                self._checked_out = wanted
+            self._users += 1
+            repo_dir = self._repo_dir
+
+        try:
+            yield repo_dir
+        finally:
+            with self._condition:
+                self._users -= 1
+                self._condition.notify_all()
+
+
+_repo_checkouts: Dict[str, RepoCheckout] = {}
+_repo_checkouts_guard = threading.Lock()
+
+
+def repo_checkout(repo_name) -> RepoCheckout:
+    """
+    The shared checkout of the repo with the given name (i.e. directory in
+    the repo cache).
+    """
+    with _repo_checkouts_guard:
+        if repo_name not in _repo_checkouts:
+            _repo_checkouts[repo_name] = RepoCheckout()
+        return _repo_checkouts[repo_name]
+
+
 def get_selected_specs(args, full_recipe_specs):
     """
     If the user gave a list of specific recipes to process,
@@ -274,20 +686,27 @@ def get_selected_specs(args, full_recipe_specs):
     Returns:
         list: list of recipes to build
     """
-    available_recipe_names = [spec["name"] for spec in full_recipe_specs]
+    # first occurrence of each recipe name
+    name_to_index: Dict[str, int] = {}
+    for index, spec in enumerate(full_recipe_specs):
+        name_to_index.setdefault(spec["name"], index)
+
     if args.start_from != "":
-        if args.start_from not in available_recipe_names:
+        start_index = name_to_index.get(args.start_from)
+        if start_index is None:
             sys.exit(
                 f"'start-from' parameter invalid: {args.start_from} not found in full_recipe_specs."
             )
-        full_recipe_specs = full_recipe_specs[
-            available_recipe_names.index(args.start_from) : :
-        ]
+        full_recipe_specs = full_recipe_specs[start_index::]
 
     if not args.selected_recipes:
         return full_recipe_specs
 
-    invalid_names = set(args.selected_recipes) - set(available_recipe_names)
+    invalid_names = [
+        name
+        for name in dict.fromkeys(args.selected_recipes)
+        if name not in name_to_index
+    ]
     if invalid_names:
         sys.exit(
             "Invalid selection: The following recipes are not listed"
@@ -295,11 +714,13 @@ def get_selected_specs(args, full_recipe_specs):
         )
 
     # Remove non-selected recipes
-    filtered_specs = list(
-        filter(lambda spec: spec["name"] in args.selected_recipes, full_recipe_specs)
-    )
+    selected_names = set(args.selected_recipes)
+    filtered_specs = [
+        spec for spec in full_recipe_specs if spec["name"] in selected_names
+    ]
     filtered_names = [spec["name"] for spec in filtered_specs]
-    if filtered_names != args.selected_recipes:
+    in_specs_order = sorted(args.selected_recipes, key=name_to_index.__getitem__)
+    if in_specs_order != args.selected_recipes:
         logger.info(
             f"WARNING: Your recipe list was not given in the same order as in {args.recipe_specs_path}."
         )
@@ -310,8 +731,48 @@ def get_selected_specs(args, full_recipe_specs):
     return filtered_specs
 
 
+def split_build_flags(flags: str, posix: bool = os.name != "nt") -> List[str]:
+    """
+    Split a spec's conda-build-flags into arguments, honoring quotes.
+
+    On Windows, backslashes are kept, as they are path separators there
+    rather than escapes. Only quotes around a whole argument are removed.
+
+    Raises ValueError for unbalanced quotes.
+
+    >>> split_build_flags('--croot "/some dir"', posix=True)
+    ['--croot', '/some dir']
+    """
+    args = shlex.split(flags, posix=posix)
+    if not posix:
+        args = [
+            arg[1:-1] if len(arg) > 1 and arg[0] == arg[-1] and arg[0] in "\"'" else arg
+            for arg in args
+        ]
+    return args
+
+
+def recipe_build_environment(recipe_spec, shared_config) -> Dict[str, str]:
+    """
+    Environment to render and build the recipe in: ours, plus the recipe's
+    'environment', plus the build parallelism if 'cpu-count' is configured
+    (and not already set in the environment).
+    """
+    build_environment = {
+        **os.environ,
+        **{k: str(v) for k, v in recipe_spec.get("environment", {}).items()},
+    }
+    if "cpu-count" in shared_config:
+        for key in ("CPU_COUNT", "CMAKE_BUILD_PARALLEL_LEVEL"):
+            build_environment.setdefault(key, str(shared_config["cpu-count"]))
+    return build_environment
+
+
 def build_and_upload_recipe(
-    recipe_spec, shared_config, conda_bld_config: conda_build.api.Config
+    recipe_spec,
+    shared_config,
+    conda_bld_config: "conda_build.api.Config",
+    existing_packages: Optional[Dict[str, List[dict]]],
 ):
     """
     Given a recipe-spec dictionary, build and upload the recipe if
@@ -321,7 +782,8 @@ def build_and_upload_recipe(
       1. Clone the recipe repo to our cache directory (if necessary)
       2. Check out the tag (with submodules, if any)
       3. Render the recipe's meta.yaml ('conda render')
-      4. Query the <destination> channel for the exact package. This includes all labels, too
+      4. Look up the exact package in existing_packages, the contents of the <destination> channel
+         (see search_channel), or search the channel for it if that is None. This includes all labels, too
          e.g. if `--label debug` is specified this will also search <destination>/label/debug,
          and <destination>/label/main!.
          If a package with the same exact rendered package string is available under a different label,
@@ -336,14 +798,15 @@ def build_and_upload_recipe(
       - environment (optional) -- Extra environment variables to define before building the recipe
       - conda-build-flags (optional) -- Extra arguments to pass to conda build for this package
       - build-on (optional) -- A list of operating systems on which the package should be built. Available are: osx, win, linux
+      - requires (optional) -- Names of recipes that need to be published before this one.
+          If not given, all recipes listed before this one are processed first.
     """
     # Extract spec fields
     package_name = recipe_spec["name"]
     recipe_repo = recipe_spec["recipe-repo"]
     tag = recipe_spec["tag"]
     recipe_subdir = recipe_spec["recipe-subdir"]
-    conda_build_flags = recipe_spec.get("conda-build-flags", "")
-    conda_build_flags = conda_build_flags.split(" ") if conda_build_flags else []
+    conda_build_flags = split_build_flags(recipe_spec.get("conda-build-flags", ""))
 
     logger.info("-------------------------------------------")
     logger.info(f"Processing {package_name}")
@@ -364,40 +827,38 @@ def build_and_upload_recipe(
         )
         return {"skipped": {"spec": recipe_spec}}
 
-    # configure build environment
-    build_environment = dict(**os.environ)
-    if "environment" in recipe_spec:
-        for key in recipe_spec["environment"].keys():
-            recipe_spec["environment"][key] = str(recipe_spec["environment"][key])
-        build_environment.update(recipe_spec["environment"])
-
-    os.chdir(shared_config["repo-cache-dir"])
-    repo_dir = checkout_recipe_repo(recipe_repo, tag)
+    build_environment = recipe_build_environment(recipe_spec, shared_config)
 
+    repo_cache_dir = shared_config["repo-cache-dir"]
+    checkout = repo_checkout(splitext(basename(recipe_repo))[0])
     # All subsequent work takes place within the recipe repo
-    os.chdir(repo_dir)
-    # Render
-    c_pkg_names = get_rendered_version(
-        package_name, recipe_subdir, build_environment, shared_config
-    )
-    logger.info(
-        f"Recipe rendered to {len(c_pkg_names)} packages: {['-'.join(map(str, x)) for x in c_pkg_names]}"
-    )
-
-    # Check our channel.  Did we already upload this version?
-    package_info = {
-        "pakage_name": package_name,
-        "recipe_versions": [x.version for x in c_pkg_names],
-        "recipe_build_string": [x.build_string for x in c_pkg_names],
-    }
-
-    packages_found = check_already_exists(c_pkg_names, shared_config)
-    if all(x[1] for x in packages_found):
+    with checkout.use(recipe_repo, tag, repo_cache_dir) as repo_dir:
+        # Render
+        c_pkg_names = get_rendered_version(
+            package_name, recipe_subdir, build_environment, shared_config, repo_dir
+        )
         logger.info(
-            f"Found {c_pkg_names} on {shared_config['destination-channel']}, skipping build."
+            f"Recipe rendered to {len(c_pkg_names)} packages: {[x.file_name for x in c_pkg_names]}"
         )
-        ret_dict = {"found": package_info}
-    else:
+
+        # Check our channel.  Did we already upload this version?
+        if existing_packages is None:
+            existing_packages = {}
+            for name in {x.package_name for x in c_pkg_names}:
+                existing_packages.update(search_channel(shared_config, name))
+        package_info = {
+            "pakage_name": package_name,
+            "recipe_versions": [x.version for x in c_pkg_names],
+            "recipe_build_string": [x.build_string for x in c_pkg_names],
+        }
+
+        packages_found = check_already_exists(c_pkg_names, existing_packages)
+        if all(x[1] for x in packages_found):
+            logger.info(
+                f"Found {c_pkg_names} on {shared_config['destination-channel']}, skipping build."
+            )
+            return {"found": package_info}
+
         # Not on our channel.  Build and upload.
         t0 = time.time()
         build_recipe(
@@ -406,63 +867,106 @@ def build_and_upload_recipe(
             conda_build_flags,
             build_environment,
             shared_config,
+            repo_dir,
         )
         package_info["build-duration"] = time.time() - t0
-        upload_package(
-            c_pkg_names,
-            shared_config,
-            conda_bld_config,
-        )
-        ret_dict = {"built": package_info}
-    return ret_dict
+
+    upload_package(
+        c_pkg_names,
+        shared_config,
+        conda_bld_config,
+    )
+    return {"built": package_info}
 
 
-def checkout_recipe_repo(recipe_repo, tag):
+# "<name>\t<url> (fetch)" lines of `git remote -v`
+_REMOTE_RE = re.compile(r"^(\S+)\s+(\S+)\s+\(fetch\)\s*$", re.MULTILINE)
+
+
+def checkout_recipe_repo(recipe_repo, tag, cwd):
     """
-    Checkout the given repository and tag.
-    Clone it first if necessary, and update any submodules it has.
+    Checkout the given repository and tag into the directory cwd.
+    Set up the repo first if necessary, and update any submodules it has.
+    Returns the path of the checkout (a directory within cwd).
+
+    Only the requested tag/branch/commit is fetched (shallowly), as we never
+    need the history of the recipe repo.
+
+    Must not be called concurrently for the same repo, use repo_checkout().
     """
-    try:
-        repo_name = splitext(basename(recipe_repo))[0]
+    repo_name = splitext(basename(recipe_repo))[0]
+    repo_dir = os.path.join(cwd, repo_name)
 
-        cwd = abspath(os.getcwd())
-        if not exists(repo_name):
+    try:
+        if not exists(repo_dir):
             # assuming url of the form github.com/remote-name/myrepo[.git]
             remote_name = recipe_repo.split("/")[-2]
+            # Not cloned: that would download the default branch, on top of
+            # the tag fetched below.
+            subprocess.check_call(["git", "init", "--quiet", repo_name], cwd=cwd)
             subprocess.check_call(
-                f"git clone -o {remote_name} {recipe_repo}", shell=True
+                ["git", "remote", "add", remote_name, recipe_repo], cwd=repo_dir
             )
-            os.chdir(repo_name)
         else:
             # The repo is already cloned in the cache,
             # but which remote do we want to fetch from?
-            os.chdir(repo_name)
-            remote_output = (
-                subprocess.check_output("git remote -v", shell=True)
-                .decode("utf-8")
-                .strip()
-            )
-            remotes = {}
-            for line in remote_output.split("\n"):
-                name, url, role = line.split()
-                remotes[url] = name
-
-            if recipe_repo in remotes:
-                remote_name = remotes[recipe_repo]
-            else:
+            remote_output = subprocess.run(
+                ["git", "remote", "-v"],
+                cwd=repo_dir,
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            remotes = {url: name for name, url in _REMOTE_RE.findall(remote_output)}
+
+            remote_name = remotes.get(recipe_repo)
+            if remote_name is None:
                 # Repo existed locally, but was missing the desired remote.
                 # Add it.
                 remote_name = recipe_repo.split("/")[-2]
                 subprocess.check_call(
-                    f"git remote add {remote_name} {recipe_repo}", shell=True
+                    ["git", "remote", "add", remote_name, recipe_repo], cwd=repo_dir
                 )
 
-            subprocess.check_call(f"git fetch {remote_name}", shell=True)
+        # Unlike `git clone --branch`, fetching works for commit hashes, too.
+        try:
+            subprocess.check_call(
+                ["git", "fetch", "--depth", "1", remote_name, tag], cwd=repo_dir
+            )
+            checkout_ref = "FETCH_HEAD"
+        except subprocess.CalledProcessError:
+            # Abbreviated commit hashes can't be fetched by name, get all
+            # branches and tags with their history and let checkout find it.
+            logger.info(f"Could not fetch {tag} directly, fetching all of {repo_name}")
+            fetch_cmd = [
+                "git",
+                "fetch",
+                "--tags",
+                remote_name,
+                f"+refs/heads/*:refs/remotes/{remote_name}/*",
+            ]
+            if exists(os.path.join(repo_dir, ".git", "shallow")):
+                fetch_cmd.insert(2, "--unshallow")
+            subprocess.check_call(fetch_cmd, cwd=repo_dir)
+            checkout_ref = tag
 
         logger.info(f"Checking out {tag} of {repo_name} into {cwd}...")
-        subprocess.check_call(f"git checkout {tag}", shell=True)
-        subprocess.check_call(f"git pull --ff-only {remote_name} {tag}", shell=True)
-        subprocess.check_call(f"git submodule update --init --recursive", shell=True)
+        subprocess.check_call(
+            ["git", "checkout", "--quiet", checkout_ref], cwd=repo_dir
+        )
+        if exists(os.path.join(repo_dir, ".gitmodules")):
+            subprocess.check_call(
+                [
+                    "git",
+                    "submodule",
+                    "update",
+                    "--init",
+                    "--recursive",
+                    "--jobs",
+                    str(os.cpu_count() or 1),
+                ],
+                cwd=repo_dir,
+            )
     except subprocess.CalledProcessError:
         raise RuntimeError(
             f"Failed to clone or update the repository: {recipe_repo}\n"
@@ -471,10 +975,9 @@ def checkout_recipe_repo(recipe_repo, tag):
 
     logger.info(f"Recipe checked out at tag: {tag}")
     logger.info("Most recent commit:")
-    subprocess.call("git log -n1", shell=True)
-    os.chdir(cwd)
+    subprocess.call(["git", "log", "-n1"], cwd=repo_dir)
 
-    return repo_name
+    return repo_dir
 
 
 def get_rendered_version(
@@ -482,6 +985,7 @@ def get_rendered_version(
     recipe_subdir,
     build_environment,
     shared_config,
+    cwd=None,
 ) -> Tuple[CCPkgName, ...]:
     """
     Use 'conda render' to process a recipe's meta.yaml (processes jinja templates and selectors).
@@ -494,69 +998,96 @@ def get_rendered_version(
     render_cmd = conda_cmd_base(CondaCommand.RENDER, shared_config) + [recipe_subdir]
     logger.info(" ".join(render_cmd))
     subprocess_output = subprocess.check_output(
-        render_cmd, env=build_environment
-    ).decode()
+        render_cmd, env=build_environment, cwd=cwd, text=True, encoding="utf-8"
+    )
 
-    rendered_filenames = [
-        x for x in subprocess_output.split() if x.endswith(".tar.bz2")
-    ]
-    name_version_builds = [
-        CCPkgName(*Path(x).name.replace(".tar.bz2", "").rsplit("-", maxsplit=2))
-        for x in rendered_filenames
-    ]
+    name_version_builds = []
+    for x in subprocess_output.split():
+        if x.endswith(PACKAGE_EXTENSIONS):
+            base_name, extension = split_package_extension(basename(x))
+            name, version, build_string = base_name.rsplit("-", maxsplit=2)
+            name_version_builds.append(
+                CCPkgName(name, version, build_string, extension)
+            )
 
     if not all(x.package_name == package_name for x in name_version_builds):
         raise RuntimeError(
-            f"Expected all outputs to be {package_name}, but got"
+            f"Expected all outputs to be {package_name}, but got "
             f"{name_version_builds}"
         )
 
     return tuple(name_version_builds)
 
 
-def check_already_exists(
-    c_pkg_names: Tuple[CCPkgName, ...], shared_config
-) -> Tuple[Tuple[CCPkgName, bool], ...]:
+def split_package_extension(file_name: str) -> Tuple[str, str]:
     """
-    Check if the given package already exists on anaconda.org in the
-    <destination> channel, including labels with the given version and build
-    string.
+    Split a package file name into its base name and package format extension.
+
+    >>> split_package_extension("abc-1.0-py_0.tar.bz2")
+    ('abc-1.0-py_0', '.tar.bz2')
+    >>> split_package_extension("abc-1.0-py_0.conda")
+    ('abc-1.0-py_0', '.conda')
+    """
+    for extension in PACKAGE_EXTENSIONS:
+        if file_name.endswith(extension):
+            return file_name[: -len(extension)], extension
+    return file_name, ""
+
+
+def search_channel(shared_config, package_spec="*") -> Dict[str, List[dict]]:
+    """
+    List the packages matching package_spec (all by default) on the
+    <destination> channel, including labels.
+
+    A single `conda search` for everything is much cheaper than one per recipe,
+    as each invocation has to start up and fetch the channel's repodata anyway.
+
+    Returns:
+        dict: package name -> list of package records, as in `conda search --json`
     """
-    # assuming all packages have the same name
-    package_name = c_pkg_names[0].package_name
     logger.info(f"Searching channel: {shared_config['destination-channel']}")
-    search_cmd = conda_cmd_base(CondaCommand.SEARCH, shared_config) + [package_name]
+    search_cmd = conda_cmd_base(CondaCommand.SEARCH, shared_config) + [package_spec]
     logger.info(" ".join(search_cmd))
 
     try:
-        search_results_text = subprocess.check_output(search_cmd).decode()
+        search_results_text = subprocess.check_output(
+            search_cmd, text=True, encoding="utf-8"
+        )
     except subprocess.CalledProcessError as e:
-        output = e.output.decode()
-        if "following packages are not available from current channels" in output:
+        if "following packages are not available from current channels" in e.output:
             search_results_text = r"{}"
         else:
             raise e
 
-    search_results = json.loads(search_results_text)
+    return json_loads(search_results_text)
 
-    if package_name not in search_results:
-        return tuple((c_pkg, False) for c_pkg in c_pkg_names)
 
-    c_pkgs_found: List[Tuple[CCPkgName, bool]] = []
-    for c_pkg_name in c_pkg_names:
-        found = False
-        for result in search_results[package_name]:
-            if (
-                result["build"] == c_pkg_name.build_string
-                and result["version"] == c_pkg_name.version
-            ):
-                found = True
-                logger.info(f"Found package {c_pkg_name}")
-                break
+def check_already_exists(
+    c_pkg_names: Tuple[CCPkgName, ...], existing_packages: Dict[str, List[dict]]
+) -> Tuple[Tuple[CCPkgName, bool], ...]:
+    """
+    Check if the given package already exists on anaconda.org in the
+    <destination> channel, including labels with the given version and build
+    string.
 
-        c_pkgs_found.append((c_pkg_name, found))
+    existing_packages are the channel contents, as returned by search_channel.
+    """
+    # assuming all packages have the same name
+    package_name = c_pkg_names[0].package_name
+    present = {
+        (record["version"], record["build"])
+        for record in existing_packages.get(package_name, [])
+    }
 
-    return tuple(c_pkgs_found)
+    c_pkgs_found = tuple(
+        (c_pkg_name, (c_pkg_name.version, c_pkg_name.build_string) in present)
+        for c_pkg_name in c_pkg_names
+    )
+    for c_pkg_name, found in c_pkgs_found:
+        if found:
+            logger.info(f"Found package {c_pkg_name}")
+
+    return c_pkgs_found
 
 
 def build_recipe(
@@ -565,6 +1096,7 @@ def build_recipe(
     build_flags,
     build_environment,
     shared_config,
+    cwd=None,
 ):
     """
     Build the recipe.
@@ -575,45 +1107,58 @@ def build_recipe(
     build_cmd.append(recipe_subdir)
     logger.info(" ".join(build_cmd))
     try:
-        subprocess.check_call(build_cmd, env=build_environment)
+        subprocess.check_call(build_cmd, env=build_environment, cwd=cwd)
     except subprocess.CalledProcessError as ex:
         sys.exit(f"Failed to build package: {package_name}")
 
 
+def find_built_package(
+    c_pkg_name: CCPkgName, conda_bld_config: "conda_build.api.Config"
+) -> str:
+    """
+    Path of the built package file in the conda-bld directory, either in the
+    subdir of the host platform (which differs from the build platform when
+    cross-compiling) or in noarch.
+
+    Only the file in the rendered package format counts, a file in the other
+    format may be left over from an earlier build.
+    """
+    for subdir in (conda_bld_config.host_subdir, "noarch"):
+        pkg_file_path = os.path.join(
+            conda_bld_config.build_folder, subdir, c_pkg_name.file_name
+        )
+        if os.path.exists(pkg_file_path):
+            return pkg_file_path
+
+    raise RuntimeError(f"Can't find built package: {c_pkg_name.file_name}")
+
+
 def upload_package(
     c_pkg_names,
     shared_config: Dict,
-    conda_bld_config: conda_build.api.Config,
+    conda_bld_config: "conda_build.api.Config",
 ):
     """
     Upload the package to the <destination> channel.
     """
-    package_paths = []
-    for c_pkg_name in c_pkg_names:
-        pkg_file_name = f"{c_pkg_name.package_name}-{c_pkg_name.version}-{c_pkg_name.build_string}.tar.bz2"
-        BUILD_PKG_DIR = conda_bld_config.build_folder
-        CONDA_PLATFORM = f"{conda_bld_config.platform}-{conda_bld_config.arch}"
-        pkg_file_path = os.path.join(BUILD_PKG_DIR, CONDA_PLATFORM, pkg_file_name)
-        if not os.path.exists(pkg_file_path):
-            # Maybe it's a noarch package?
-            pkg_file_path = os.path.join(BUILD_PKG_DIR, "noarch", pkg_file_name)
-        if not os.path.exists(pkg_file_path):
-            raise RuntimeError(f"Can't find built package: {pkg_file_name}")
-
-        package_paths.append(pkg_file_path)
-
-    upload_cmd = (
-        f"anaconda {shared_config['token-string']} upload --skip-existing -u {shared_config['upload-channel']}"
-        f" {labels_to_upload_string(shared_config['labels'])} "
-        f"{' '.join(package_paths)}"
+    package_paths = [
+        find_built_package(c_pkg_name, conda_bld_config) for c_pkg_name in c_pkg_names
+    ]
+
+    token = shared_config["token"]
+    upload_cmd = ["anaconda"]
+    if token:
+        upload_cmd.extend(["-t", token])
+    upload_cmd.extend(
+        ["upload", "--skip-existing", "-u", shared_config["upload-channel"]]
     )
+    upload_cmd.extend(labels_to_upload_args(shared_config["labels"]))
+    upload_cmd.extend(package_paths)
     logger.info(f"Uploading {package_paths}")
     try:
-        subprocess.check_call(upload_cmd, shell=True)
+        subprocess.check_call(upload_cmd)
     except subprocess.CalledProcessError as e:
-        # clean up token string in case of errors
-        if shared_config["token-string"] != "":
-            e.cmd = e.cmd.replace(
-                shared_config["token-string"], "<token-string removed>"
-            )
+        # clean up token in case of errors
+        if token:
+            e.cmd = ["<token removed>" if arg == token else arg for arg in e.cmd]
         raise
@@ -1,11 +1,22 @@
-import re
+from functools import lru_cache
 from itertools import chain
-from typing import List, Tuple, Union
+from typing import List, Sequence, Tuple, Union
 
 
-def labels_to_upload_string(label_list: List[str]) -> str:
+@lru_cache(maxsize=None)
+def _labels_to_args(
+    option: str, labels: Tuple[str, ...], prefix: str = ""
+) -> Tuple[str, ...]:
+    # Labels don't change during a run, so this is computed once per use case.
+    return tuple(chain.from_iterable((option, f"{prefix}{label}") for label in labels))
+
+
+def labels_to_upload_string(label_list: Sequence[str]) -> str:
     """generates a string suitable for anaconda upload
 
+    Deprecated: labels can't be quoted safely in a command string, use
+    labels_to_upload_args instead.
+
     Examples:
 
     >>> labels_to_upload_string(['debug', 'devel'])
@@ -13,10 +24,25 @@ def labels_to_upload_string(label_list: List[str]) -> str:
     >>> labels_to_upload_string([])
     ''
     """
-    return " ".join(f"--label {label}" for label in label_list)
+    return " ".join(_labels_to_args("--label", tuple(label_list)))
+
+
+def labels_to_upload_args(label_list: Sequence[str]) -> List[str]:
+    """generates arguments suitable for anaconda upload
+
+    Examples:
+
+    >>> labels_to_upload_args(['debug', 'devel'])
+    ['--label', 'debug', '--label', 'devel']
+    >>> labels_to_upload_args([])
+    []
+    """
+    return list(_labels_to_args("--label", tuple(label_list)))
 
 
-def labels_to_search_args(destination_channel: str, label_list: List[str]) -> List[str]:
+def labels_to_search_args(
+    destination_channel: str, label_list: Sequence[str]
+) -> List[str]:
     """generates a string suitable for conda search
 
     Examples:
@@ -28,11 +54,8 @@ def labels_to_search_args(destination_channel: str, label_list: List[str]) -> Li
     []
     """
     return list(
-        chain(
-            *[
-                ("--channel", f"{destination_channel}/label/{label}")
-                for label in label_list
-            ]
+        _labels_to_args(
+            "--channel", tuple(label_list), prefix=f"{destination_channel}/label/"
         )
     )
 
@@ -52,11 +75,10 @@ def strip_label(channel_string: str) -> Tuple[str, Union[str, None]]:
     ('some-channel', 'some-label')
     >>> strip_label("some-channel")
     ('some-channel', None)
+    >>> strip_label("some-channel/label/some.label")
+    ('some-channel/label/some.label', None)
     """
-    regex = re.compile("/label/" + "(?P<label>[a-zA-Z0-9\-]+)" + "\Z")
-    res = regex.search(channel_string)
-    if res is None:
-        return channel_string, None
-    else:
-        label = res.groupdict()["label"]
-        return channel_string.split(f"/label/{label}")[0], label
+    head, sep, label = channel_string.rpartition("/label/")
+    if sep and label and all(c.isascii() and (c.isalnum() or c == "-") for c in label):
+        return head, label
+    return channel_string, None
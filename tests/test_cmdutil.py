@@ -1,6 +1,6 @@
 import pytest
 
-from publish_conda_stack.cmdutil import CondaCommand, conda_cmd_base
+from publish_conda_stack.cmdutil import CondaCommand, conda_cmd_base, default_backend
 
 
 @pytest.fixture
@@ -118,3 +118,35 @@ def test_source_channel_list_updated(command, channel_list, minimal_shared_confi
     minimal_shared_config.update({"conda-source-channel-list": channel_list})
     cmd_base = conda_cmd_base(command, minimal_shared_config)
     assert " ".join(channel_list) in " ".join(cmd_base)
+
+
+@pytest.mark.parametrize(
+    "command",
+    [
+        CondaCommand.SEARCH,
+        CondaCommand.BUILD,
+    ],
+)
+def test_unknown_backend_raises(command, minimal_shared_config):
+    minimal_shared_config.update({"backend": "pip"})
+    with pytest.raises(ValueError):
+        conda_cmd_base(command, minimal_shared_config)
+
+
+def test_unknown_command_raises(minimal_shared_config):
+    with pytest.raises(ValueError):
+        conda_cmd_base(42, minimal_shared_config)
+
+
+@pytest.mark.parametrize(
+    "mamba_path,boa_spec,expected",
+    [
+        ("/usr/bin/mamba", object(), "mamba"),
+        (None, object(), "conda"),
+        ("/usr/bin/mamba", None, "conda"),
+    ],
+)
+def test_default_backend(mocker, mamba_path, boa_spec, expected):
+    mocker.patch("shutil.which", return_value=mamba_path)
+    mocker.patch("importlib.util.find_spec", return_value=boa_spec)
+    assert default_backend() == expected
@@ -1,211 +1,137 @@
 import os
 import subprocess
+from types import SimpleNamespace
 
 import pytest
 
-from publish_conda_stack.core import CCPkgName, upload_package
-from publish_conda_stack.util import labels_to_upload_string
+from publish_conda_stack.core import CCPkgName, find_built_package, upload_package
+from publish_conda_stack.util import labels_to_upload_args
+
+TEST_CHANNEL = "test_channel"
+BUILD_FOLDER = "/some/folder"
+HOST_SUBDIR = "linux-64"
+# where the built packages are expected
+PACKAGE_DIR = os.path.join(BUILD_FOLDER, HOST_SUBDIR)
+
+PKG_PY_1 = CCPkgName("test_package", "0.1.0", "py_1")
+PKG_PY_2 = CCPkgName("test_package", "0.1.0", "py_2")
+
+BASE_SHARED_CONFIG = {
+    "destination-channel": TEST_CHANNEL,
+    "upload-channel": TEST_CHANNEL,
+}
+
+
+@pytest.fixture(scope="module")
+def conda_bld_config():
+    # upload_package only reads these attributes
+    return SimpleNamespace(build_folder=BUILD_FOLDER, host_subdir=HOST_SUBDIR)
+
+
+@pytest.fixture
+def upload_mocks(mocker):
+    """
+    Pretend all built packages exist, and don't actually run anaconda upload.
+    """
+    return SimpleNamespace(
+        check_call=mocker.patch("subprocess.check_call"),
+        exists=mocker.patch("os.path.exists", return_value=True),
+    )
 
 
 @pytest.mark.parametrize(
-    "labels,token_string", [(["main"], ""), (["test", "staging"], "-t abc")]
+    "labels,token,c_pkg_names",
+    [
+        (["main"], "", (PKG_PY_1,)),
+        (["test", "staging"], "abc", (PKG_PY_1,)),
+        (["blah"], "", (PKG_PY_1, PKG_PY_2)),
+    ],
 )
-def test_upload(mocker, labels, token_string):
-    # Mocking:
-    mocker.patch("subprocess.check_call")
-    mocker.patch("os.path.exists")
-    os.path.exists.return_value = True
-
-    test_channel = "test_channel"
-    label_string = labels_to_upload_string(labels)
-    build_folder = "/some/folder"
-    platform = "linux"
-    arch = "64"
-
-    package_name = "test_package"
-    recipe_version = "0.1.0"
-    recipe_build_string = "py_1"
-
-    c_pkg_names = (CCPkgName(package_name, recipe_version, recipe_build_string),)
-
-    shared_config = {
-        "destination-channel": test_channel,
-        "labels": labels,
-        "token-string": token_string,
-        "upload-channel": test_channel,
-    }
-    conda_bld_config = mocker.Mock(
-        build_folder=build_folder, platform=platform, arch=arch
-    )
+def test_upload(mocker, upload_mocks, conda_bld_config, labels, token, c_pkg_names):
+    shared_config = {**BASE_SHARED_CONFIG, "labels": labels, "token": token}
     upload_package(
         c_pkg_names,
         shared_config,
         conda_bld_config,
     )
 
-    test_path = os.path.join(
-        build_folder,
-        f"{platform}-{arch}",
-        f"{package_name}-{recipe_version}-{recipe_build_string}.tar.bz2",
-    )
-    assert os.path.exists.call_count == 2
-    subprocess.check_call.assert_called_once_with(
-        f"anaconda {token_string} upload --skip-existing -u {test_channel} {label_string} {test_path}",
-        shell=True,
+    test_paths = [
+        os.path.join(PACKAGE_DIR, c_pkg_name.file_name) for c_pkg_name in c_pkg_names
+    ]
+    token_args = ["-t", token] if token else []
+    assert upload_mocks.exists.call_args_list == [mocker.call(p) for p in test_paths]
+    upload_mocks.check_call.assert_called_once_with(
+        [
+            "anaconda",
+            *token_args,
+            "upload",
+            "--skip-existing",
+            "-u",
+            TEST_CHANNEL,
+            *labels_to_upload_args(labels),
+            *test_paths,
+        ]
     )
 
 
-def test_hide_token(mocker):
-    labels = ["blah"]
-    label_string = labels_to_upload_string(labels)
-    token_string = "-t ohoh"
-    test_channel = "test_channel"
-    build_folder = "/some/folder"
-    platform = "linux"
-    arch = "64"
-
-    package_name = "test_package"
-    recipe_version = "0.1.0"
-    recipe_build_string = "py_1"
-
-    c_pkg_names = (CCPkgName(package_name, recipe_version, recipe_build_string),)
-
-    shared_config = {
-        "destination-channel": test_channel,
-        "labels": labels,
-        "token-string": token_string,
-        "upload-channel": test_channel,
-    }
-    conda_bld_config = mocker.Mock(
-        build_folder=build_folder, platform=platform, arch=arch
-    )
-
-    test_path = os.path.join(
-        build_folder,
-        f"{platform}-{arch}",
-        f"{package_name}-{recipe_version}-{recipe_build_string}.tar.bz2",
-    )
-    cmd = f"anaconda {token_string} upload --skip-existing -u {test_channel} {label_string} {test_path}"
+def test_hide_token(upload_mocks, conda_bld_config):
+    token = "ohoh"
+    shared_config = {**BASE_SHARED_CONFIG, "labels": ["blah"], "token": token}
 
     def side_effect(callable_str, *args, **kwargs):
         raise subprocess.CalledProcessError(cmd=callable_str, returncode=1)
 
-    # Mocking:
-    mocker.patch("subprocess.check_call")
-    mocker.patch("os.path.exists")
-    subprocess.check_call.side_effect = side_effect
-    os.path.exists.return_value = True
+    upload_mocks.check_call.side_effect = side_effect
 
     try:
         upload_package(
-            c_pkg_names,
+            (PKG_PY_1,),
             shared_config,
             conda_bld_config,
         )
     except subprocess.CalledProcessError as e:
-        assert token_string not in e.cmd
+        assert token not in e.cmd
+        assert "<token removed>" in e.cmd
     else:
         assert False, "Expected subprocess.CalledProcessError!!!"
 
 
-def test_upload_channel(mocker):
-    # Mocking:
-    mocker.patch("subprocess.check_call")
-    mocker.patch("os.path.exists")
-    os.path.exists.return_value = True
-
-    arch = "64"
-    build_folder = "/some/folder"
-    labels = ["blah"]
-    label_string = labels_to_upload_string(labels)
-    platform = "linux"
-    test_channel = "test_channel"
-    token_string = ""
-
-    package_name = "test_package"
-    recipe_build_string = "py_1"
-    recipe_version = "0.1.0"
-
-    c_pkg_names = (CCPkgName(package_name, recipe_version, recipe_build_string),)
-    shared_config = {
-        "destination-channel": f"{test_channel}/label/blah",
-        "labels": labels,
-        "token-string": token_string,
-        "upload-channel": test_channel,
-    }
-    conda_bld_config = mocker.Mock(
-        build_folder=build_folder, platform=platform, arch=arch
-    )
-
-    upload_package(
-        c_pkg_names,
-        shared_config,
-        conda_bld_config,
+@pytest.mark.parametrize(
+    "extension,existing,expected",
+    [
+        (
+            ".tar.bz2",
+            ["linux-64/pkg-1.0-py_1.tar.bz2"],
+            "linux-64/pkg-1.0-py_1.tar.bz2",
+        ),
+        (".conda", ["noarch/pkg-1.0-py_1.conda"], "noarch/pkg-1.0-py_1.conda"),
+        # left over from building the same package in the old format
+        (
+            ".conda",
+            ["linux-64/pkg-1.0-py_1.tar.bz2", "linux-64/pkg-1.0-py_1.conda"],
+            "linux-64/pkg-1.0-py_1.conda",
+        ),
+    ],
+)
+def test_find_built_package(tmp_path, extension, existing, expected):
+    for file_name in existing:
+        (tmp_path / file_name).parent.mkdir(exist_ok=True)
+        (tmp_path / file_name).touch()
+    conda_bld_config = SimpleNamespace(
+        build_folder=str(tmp_path), host_subdir="linux-64"
     )
 
-    test_path = os.path.join(
-        build_folder,
-        f"{platform}-{arch}",
-        f"{package_name}-{recipe_version}-{recipe_build_string}.tar.bz2",
+    pkg_file_path = find_built_package(
+        CCPkgName("pkg", "1.0", "py_1", extension), conda_bld_config
     )
-    assert os.path.exists.call_count == 2
-    subprocess.check_call.assert_called_once_with(
-        f"anaconda {token_string} upload --skip-existing -u {test_channel} {label_string} {test_path}",
-        shell=True,
-    )
-
 
-def test_upload_multiple(mocker):
-    # Mocking:
-    mocker.patch("subprocess.check_call")
-    mocker.patch("os.path.exists")
-    os.path.exists.return_value = True
+    assert pkg_file_path == str(tmp_path / expected)
 
-    arch = "64"
-    build_folder = "/some/folder"
-    labels = ["blah"]
-    label_string = labels_to_upload_string(labels)
-    platform = "linux"
-    test_channel = "test_channel"
-    token_string = ""
-
-    package_name = "test_package"
-    recipe_build_string = "py_1"
-    recipe_version = "0.1.0"
-
-    c_pkg_names = (
-        CCPkgName(package_name, recipe_version, recipe_build_string),
-        CCPkgName(package_name, recipe_version, "py_2"),
-    )
-
-    shared_config = {
-        "destination-channel": f"{test_channel}/label/blah",
-        "labels": labels,
-        "token-string": token_string,
-        "upload-channel": test_channel,
-    }
-    conda_bld_config = mocker.Mock(
-        build_folder=build_folder, platform=platform, arch=arch
-    )
 
-    upload_package(
-        c_pkg_names,
-        shared_config,
-        conda_bld_config,
+def test_find_built_package_missing(tmp_path):
+    conda_bld_config = SimpleNamespace(
+        build_folder=str(tmp_path), host_subdir="linux-64"
     )
 
-    test_paths = [
-        os.path.join(
-            build_folder,
-            f"{platform}-{arch}",
-            f"{c_pkg_name.package_name}-{c_pkg_name.version}-{c_pkg_name.build_string}.tar.bz2",
-        )
-        for c_pkg_name in c_pkg_names
-    ]
-
-    assert os.path.exists.call_count == 2 * len(test_paths)
-
-    subprocess.check_call.assert_called_once_with(
-        f"anaconda {token_string} upload --skip-existing -u {test_channel} {label_string} {' '.join(test_paths)}",
-        shell=True,
-    )
+    with pytest.raises(RuntimeError):
+        find_built_package(CCPkgName("pkg", "1.0", "py_1"), conda_bld_config)
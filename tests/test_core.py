@@ -1,89 +1,117 @@
+import os
 import subprocess
+import sys
+import threading
+import time
+from argparse import Namespace
 from textwrap import dedent
 
 import pytest
 
 from publish_conda_stack.core import (
     CCPkgName,
+    RepoCheckout,
+    append_progress,
     check_already_exists,
+    check_recipe_requires,
+    checkout_recipe_repo,
     get_rendered_version,
+    get_selected_specs,
+    iter_recipe_names,
+    load_recipe_names,
+    main,
+    parse_specs,
+    print_recipe_list,
+    recipe_build_environment,
+    recipe_dependency_graph,
+    recipe_names_cache_path,
+    safe_yaml,
+    search_channel,
+    split_build_flags,
+    write_result,
 )
 
 
+@pytest.fixture
+def mock_check_output(mocker):
+    """
+    Factory for a mock replacing subprocess.check_output
+    """
+
+    def make_mock(return_value=None, side_effect=None):
+        return mocker.patch(
+            "subprocess.check_output",
+            return_value=return_value,
+            side_effect=side_effect,
+        )
+
+    return make_mock
+
+
+# `conda render --output` of a recipe that applies patches
+PATCH_OUTPUT = "Patch level ambiguous, selecting least deep\nPatch analysis gives:\n[[ RA-MD1--VE ]] - [[                                       0001-fix-whatever.patch ]]\n\nKey:\n\nR :: Reversible                       A :: Applicable\nY :: Build-prefix patch in use        M :: Minimal, non-amalgamated\nD :: Dry-runnable                     N :: Patch level (1 is preferred)\nL :: Patch level not-ambiguous        O :: Patch applies without offsets\nV :: Patch applies without fuzz       E :: Patch applies without emitting to stderr\n\n/some/path/abc-1.0.0-0py0whatever.tar.bz2\n"
+
+
 @pytest.mark.parametrize(
-    "c_package_names,expected",
+    "package_name,c_package_names,expected",
     [
         (
+            "abc",
             "/some/path/abc-1.0.0-0py0.tar.bz2",
-            (
-                CCPkgName(
-                    "abc",
-                    "1.0.0",
-                    "0py0",
-                ),
-            ),
+            (CCPkgName("abc", "1.0.0", "0py0"),),
         ),
         (
+            "abc",
             "/some/path/abc-1.0.0-0py0.tar.bz2\n/some/path/abc-1.0.0-1py2.tar.bz2",
-            (
-                CCPkgName(
-                    "abc",
-                    "1.0.0",
-                    "0py0",
-                ),
-                CCPkgName(
-                    "abc",
-                    "1.0.0",
-                    "1py2",
-                ),
-            ),
+            (CCPkgName("abc", "1.0.0", "0py0"), CCPkgName("abc", "1.0.0", "1py2")),
         ),
         # windows style line endings
         (
+            "abc",
             "/some/path/abc-1.0.0-0py0.tar.bz2\r\n/some/path/abc-1.0.0-1py2.tar.bz2",
+            (CCPkgName("abc", "1.0.0", "0py0"), CCPkgName("abc", "1.0.0", "1py2")),
+        ),
+        # packages in the .conda format
+        (
+            "abc",
+            "/some/path/abc-1.0.0-0py0.conda\n/some/path/abc-1.0.0-1py2.tar.bz2",
             (
-                CCPkgName(
-                    "abc",
-                    "1.0.0",
-                    "0py0",
-                ),
-                CCPkgName(
-                    "abc",
-                    "1.0.0",
-                    "1py2",
-                ),
+                CCPkgName("abc", "1.0.0", "0py0", ".conda"),
+                CCPkgName("abc", "1.0.0", "1py2"),
             ),
         ),
+        # package names with hyphens don't cause issues
+        (
+            "a-b-c",
+            "/some/path/a-b-c-1.0.0-0py0.tar.bz2",
+            (CCPkgName("a-b-c", "1.0.0", "0py0"),),
+        ),
+        # other output (e.g. from applying patches) is ignored
+        (
+            "abc",
+            PATCH_OUTPUT,
+            (CCPkgName("abc", "1.0.0", "0py0whatever"),),
+        ),
     ],
 )
-def test_get_rendered_version(mocker, c_package_names, expected):
-    subprocess_mock = mocker.Mock()
-    subprocess_mock.return_value = c_package_names.encode()
-    mocker.patch("subprocess.check_output", new=subprocess_mock)
+def test_get_rendered_version(
+    mock_check_output, package_name, c_package_names, expected
+):
+    mock_check_output(return_value=c_package_names)
     res = get_rendered_version(
-        "abc", "mock_path", "bld_env", {"conda-source-channel-list": ["-c", "ignore"]}
+        package_name,
+        "mock_path",
+        "bld_env",
+        {"conda-source-channel-list": ["-c", "ignore"]},
     )
 
-    assert len(res) == len(expected)
     assert res == expected
 
 
-def test_get_rendered_version_hyphen_pkg(mocker):
-    """ensure package names with hyphens don't cause issues"""
-    subprocess_mock = mocker.Mock()
-    subprocess_mock.return_value = "/some/path/a-b-c-1.0.0-0py0.tar.bz2".encode()
-    mocker.patch("subprocess.check_output", new=subprocess_mock)
-    res = get_rendered_version(
-        "a-b-c", "mock_path", "bld_env", {"conda-source-channel-list": ["-c", "ignore"]}
+def test_get_rendered_version_raises(mock_check_output):
+    mock_check_output(
+        return_value="/some/path/abc-1.0.0-0py0.tar.bz2\n/some/path/notabc-1.0.0-1py2.tar.bz2"
     )
-    assert len(res) == 1
-    assert res[0].package_name == "a-b-c"
-
-
-def test_get_rendered_version_raises(mocker):
-    subprocess_mock = mocker.Mock()
-    subprocess_mock.return_value = "/some/path/abc-1.0.0-0py0.tar.bz2\n/some/path/notabc-1.0.0-1py2.tar.bz2".encode()
-    mocker.patch("subprocess.check_output", new=subprocess_mock)
     with pytest.raises(RuntimeError):
         _ = get_rendered_version(
             "abc",
@@ -93,21 +121,77 @@ def test_get_rendered_version_raises(mocker):
         )
 
 
-def test_get_rendered_version_ignores_patch_outputs(mocker):
-    subprocess_mock = mocker.Mock()
-    subprocess_mock.return_value = "Patch level ambiguous, selecting least deep\nPatch analysis gives:\n[[ RA-MD1--VE ]] - [[                                       0001-fix-whatever.patch ]]\n\nKey:\n\nR :: Reversible                       A :: Applicable\nY :: Build-prefix patch in use        M :: Minimal, non-amalgamated\nD :: Dry-runnable                     N :: Patch level (1 is preferred)\nL :: Patch level not-ambiguous        O :: Patch applies without offsets\nV :: Patch applies without fuzz       E :: Patch applies without emitting to stderr\n\n/some/path/abc-1.0.0-0py0whatever.tar.bz2\n".encode()
-    mocker.patch("subprocess.check_output", new=subprocess_mock)
-    expected = CCPkgName("abc", "1.0.0", "0py0whatever")
+# `conda search --json` output, mypack 1.0 is on the channel
+SEARCH_JSON_ONE = (
+    '{"mypack": [{"build": "py38_0_hblah", "build_number": 0, "name": "mypack",'
+    ' "version": "1.0"}]}'
+)
+# ... as well as an older version with the same build string
+SEARCH_JSON_TWO = (
+    '{"mypack": [{"build": "py38_0_hblah", "build_number": 0, "name": "mypack",'
+    ' "version": "1.0"}, {"build": "py38_0_hblah", "build_number": 0,'
+    ' "name": "mypack", "version": "0.9"}]}'
+)
 
-    res = get_rendered_version(
-        "abc", "mock_path", "bld_env", {"conda-source-channel-list": ["-c", "ignore"]}
-    )
 
-    assert len(res) == 1
-    assert res[0] == expected
+# `mamba search` output for a channel without any packages yet
+SEARCH_NOT_AVAILABLE_OUTPUT = dedent(
+    """
+        The following packages are not available from current channels:
 
+          - ilastik-launch
 
-def test_check_already_exists(mocker):
+        Current channels:
+
+          - https://conda.anaconda.org/mock_channel/osx-64
+          - https://conda.anaconda.org/mock_channel/noarch
+
+        To search for alternate channels that may provide the conda package you're
+        looking for, navigate to
+
+            https://anaconda.org
+
+        and use the search bar at the top of the page.
+
+        Traceback (most recent call last):
+          File "/Users/user/mambaforge/bin/publish-conda-stack", line 10, in <module>
+            sys.exit(main())
+          File "/Users/user/mambaforge/lib/python3.9/site-packages/publish_conda_stack/core.py", line 227, in main
+            raise e
+          File "/Users/user/mambaforge/lib/python3.9/site-packages/publish_conda_stack/core.py", line 223, in main
+            status = build_and_upload_recipe(spec, shared_config, conda_bld_config)
+          File "/Users/user/mambaforge/lib/python3.9/site-packages/publish_conda_stack/core.py", line 390, in build_and_upload_recipe
+            packages_found = check_already_exists(c_pkg_names, shared_config)
+          File "/Users/user/mambaforge/lib/python3.9/site-packages/publish_conda_stack/core.py", line 527, in check_already_exists
+            search_results_text = subprocess.check_output(search_cmd).decode()
+          File "/Users/user/mambaforge/lib/python3.9/subprocess.py", line 424, in check_output
+            return run(*popenargs, stdout=PIPE, timeout=timeout, check=True,
+          File "/Users/user/mambaforge/lib/python3.9/subprocess.py", line 528, in run
+            raise CalledProcessError(retcode, process.args,
+        subprocess.CalledProcessError: Command '['mamba', 'search', '--json', '--full-name', '--override-channels', '--channel', 'mock_channel', 'mypack']' returned non-zero exit status 1.
+    """
+)
+
+
+# `conda search` failing, as it does for a channel without any packages
+SEARCH_NOT_AVAILABLE_ERROR = subprocess.CalledProcessError(
+    returncode=1,
+    cmd="['mamba', 'search', '--json', '--full-name', '--override-channels', '--channel', 'ilastik-forge', 'ilastik-launch']",
+    output=SEARCH_NOT_AVAILABLE_OUTPUT,
+)
+
+
+@pytest.mark.parametrize(
+    "search_output,search_error,expected_found",
+    [
+        (SEARCH_JSON_ONE, None, True),
+        (SEARCH_JSON_TWO, None, True),
+        (None, SEARCH_NOT_AVAILABLE_ERROR, False),
+    ],
+)
+def test_check_already_exists(
+    mock_check_output, search_output, search_error, expected_found
+):
     c_pkg_names = (CCPkgName("mypack", "1.0", "py38_0_hblah"),)
     shared_config = {
         "destination-channel": "mock-channel",
@@ -115,24 +199,11 @@ def test_check_already_exists(mocker):
         "upload-channel": "blah-forge",
     }
 
-    subprocess_mock = mocker.Mock()
-    subprocess_mock.return_value = dedent(
-        """
-    {
-      "mypack": [
-        {
-          "build": "py38_0_hblah",
-          "build_number": 0,
-          "name": "mypack",
-          "version": "1.0"
-        }
-      ]
-    }
-    """
-    ).encode()
-    mocker.patch("subprocess.check_output", new=subprocess_mock)
+    subprocess_mock = mock_check_output(
+        return_value=search_output, side_effect=search_error
+    )
 
-    pkgs_found = check_already_exists(c_pkg_names, shared_config)
+    pkgs_found = check_already_exists(c_pkg_names, search_channel(shared_config))
 
     subprocess_mock.assert_called_once_with(
         [
@@ -145,139 +216,641 @@ def test_check_already_exists(mocker):
             "blah-forge",
             "--channel",
             "blah-forge/label/test",
-            "mypack",
-        ]
+            "*",
+        ],
+        text=True,
+        encoding="utf-8",
+    )
+
+    assert pkgs_found == ((c_pkg_names[0], expected_found),)
+
+
+def test_load_recipe_names_cached(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    specs_path = tmp_path / "specs.yaml"
+    specs_path.write_text(
+        dedent(
+            """
+            recipe-specs:
+              - name: abc
+              - name: a-b-c
+            """
+        )
+    )
+
+    assert load_recipe_names(specs_path) == ["abc", "a-b-c"]
+    cache_key, *cached_names = (
+        recipe_names_cache_path(specs_path).read_text().splitlines()
     )
+    assert cached_names == ["abc", "a-b-c"]
 
-    assert len(pkgs_found) == 1
-    assert pkgs_found[0][0] == c_pkg_names[0]
-    assert pkgs_found[0][1]
+    # served from the cache as long as the specs file is unchanged
+    recipe_names_cache_path(specs_path).write_text(f"{cache_key}\nfrom-cache")
+    assert load_recipe_names(specs_path) == ["from-cache"]
 
 
-def test_check_already_exists_doesnt_add(mocker):
+def test_load_recipe_names_stale_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    specs_path = tmp_path / "specs.yaml"
+    specs_path.write_text("recipe-specs:\n  - name: abc\n")
+    assert load_recipe_names(specs_path) == ["abc"]
+
+    specs_mtime = os.path.getmtime(specs_path)
+    specs_path.write_text("recipe-specs:\n  - name: abc\n  - name: def\n")
+    # e.g. replaced by an older copy, still older than the cache file
+    os.utime(specs_path, (specs_mtime - 10, specs_mtime - 10))
+
+    assert load_recipe_names(specs_path) == ["abc", "def"]
+
+
+def test_check_already_exists_other_package():
     c_pkg_names = (CCPkgName("mypack", "1.0", "py38_0_hblah"),)
+    existing_packages = {
+        "otherpack": [{"build": "py38_0_hblah", "name": "otherpack", "version": "1.0"}]
+    }
+
+    pkgs_found = check_already_exists(c_pkg_names, existing_packages)
+
+    assert pkgs_found == ((c_pkg_names[0], False),)
+
+
+def test_search_channel_single_package(mock_check_output):
     shared_config = {
-        "destination-channel": "mock-channel",
-        "labels": ["test"],
+        "destination-channel": "blah-forge",
         "upload-channel": "blah-forge",
+        "conda-source-channel-list": [],
     }
+    subprocess_mock = mock_check_output(return_value="{}")
 
-    subprocess_mock = mocker.Mock()
-    subprocess_mock.return_value = dedent(
-        """
-    {
-      "mypack": [
-        {
-          "build": "py38_0_hblah",
-          "build_number": 0,
-          "name": "mypack",
-          "version": "1.0"
-        },
-        {
-          "build": "py38_0_hblah",
-          "build_number": 0,
-          "name": "mypack",
-          "version": "0.9"
-        }
-      ]
-    }
+    assert search_channel(shared_config, "mypack") == {}
+    search_cmd = subprocess_mock.call_args.args[0]
+    assert search_cmd[-1] == "mypack"
+
+
+def _done_before(recipe_specs):
+    """
+    Map spec index -> set of spec indices that were done before it was ready
     """
-    ).encode()
-    mocker.patch("subprocess.check_output", new=subprocess_mock)
+    graph = recipe_dependency_graph(recipe_specs)
+    graph.prepare()
+    done = set()
+    dependencies = {}
+    while graph.is_active():
+        ready = graph.get_ready()
+        for spec_index in ready:
+            dependencies[spec_index] = set(done)
+        for spec_index in ready:
+            graph.done(spec_index)
+            done.add(spec_index)
+    return dependencies
+
+
+def test_recipe_dependency_graph_keeps_file_order():
+    recipe_specs = [{"name": "a"}, {"name": "b"}, {"name": "c"}]
+    graph = recipe_dependency_graph(recipe_specs)
+    assert list(graph.static_order()) == [0, 1, 2]
+
+
+def test_recipe_dependency_graph_requires():
+    recipe_specs = [
+        {"name": "a"},
+        {"name": "b", "requires": []},
+        {"name": "c", "requires": ["a", "not-selected"]},
+        {"name": "d"},
+    ]
+    done_before = _done_before(recipe_specs)
+
+    # a and b are independent and processed together
+    assert done_before[0] == set()
+    assert done_before[1] == set()
+    assert 0 in done_before[2]
+    # d waits for everything listed before it
+    assert done_before[3] == {0, 1, 2}
+
+
+def test_main_finishes_running_builds_on_failure(mocker, tmp_path):
+    result_file = tmp_path / "out.yaml"
+    args = Namespace(
+        list=False,
+        logfile=str(result_file),
+        no_search_cache=False,
+        jobs=3,
+        token="",
+    )
+    recipe_specs = [
+        {"name": "a", "requires": []},
+        {"name": "b", "requires": []},
+        {"name": "c", "requires": []},
+        {"name": "d"},
+    ]
+    mocker.patch("publish_conda_stack.core.parse_cmdline_args", return_value=args)
+    mocker.patch(
+        "publish_conda_stack.core.parse_specs",
+        return_value=({"backend": "conda"}, recipe_specs),
+    )
+    mocker.patch("publish_conda_stack.core.search_channel", return_value={})
+    conda_build = mocker.MagicMock()
+    mocker.patch.dict(
+        sys.modules, {"conda_build": conda_build, "conda_build.api": conda_build.api}
+    )
 
-    pkgs_found = check_already_exists(c_pkg_names, shared_config)
+    a_failed = threading.Event()
+
+    def build_and_upload_recipe(spec, *args):
+        if spec["name"] == "a":
+            a_failed.set()
+            sys.exit("Failed to build package: a")
+        # still running while the failure of a is handled
+        a_failed.wait()
+        time.sleep(0.1)
+        if spec["name"] == "c":
+            raise RuntimeError("upload failed")
+        return {"built": {"pakage_name": spec["name"]}}
+
+    mocker.patch(
+        "publish_conda_stack.core.build_and_upload_recipe",
+        side_effect=build_and_upload_recipe,
+    )
 
-    subprocess_mock.assert_called_once_with(
+    with pytest.raises(SystemExit, match="package: a"):
+        main()
+
+    result = safe_yaml().load(result_file)
+    assert result["built"] == [{"pakage_name": "b"}]
+    assert sorted(error["spec"]["name"] for error in result["errors"]) == ["a", "c"]
+
+
+def test_main_writes_result_on_failed_search(mocker, tmp_path):
+    result_file = tmp_path / "out.yaml"
+    args = Namespace(
+        list=False,
+        logfile=str(result_file),
+        no_search_cache=False,
+        jobs=1,
+        token="",
+    )
+    mocker.patch("publish_conda_stack.core.parse_cmdline_args", return_value=args)
+    mocker.patch(
+        "publish_conda_stack.core.parse_specs",
+        return_value=({"backend": "conda"}, [{"name": "a"}]),
+    )
+    mocker.patch(
+        "publish_conda_stack.core.search_channel",
+        side_effect=subprocess.CalledProcessError(1, ["conda", "search"]),
+    )
+    conda_build = mocker.MagicMock()
+    mocker.patch.dict(
+        sys.modules, {"conda_build": conda_build, "conda_build.api": conda_build.api}
+    )
+
+    with pytest.raises(subprocess.CalledProcessError):
+        main()
+
+    result = safe_yaml().load(result_file)
+    assert len(result["errors"]) == 1
+
+
+@pytest.mark.parametrize(
+    "recipe_specs,message",
+    [
+        ([{"name": "a", "requires": ["typo"]}], "a requires typo"),
+        (
+            [{"name": "a", "requires": ["b"]}, {"name": "b", "requires": ["a"]}],
+            "circular",
+        ),
+        # b (implicitly) depends on a, which is listed before it
+        ([{"name": "a", "requires": ["b"]}, {"name": "b"}], "circular"),
+    ],
+)
+def test_check_recipe_requires_invalid(recipe_specs, message):
+    with pytest.raises(SystemExit, match=message):
+        check_recipe_requires(recipe_specs)
+
+
+def test_check_recipe_requires():
+    check_recipe_requires(
+        [{"name": "a"}, {"name": "b", "requires": []}, {"name": "c", "requires": ["b"]}]
+    )
+
+
+def test_split_build_flags_windows_path():
+    windows_flags = split_build_flags(r"--croot C:\bld\tmp --no-test", posix=False)
+    assert windows_flags == ["--croot", r"C:\bld\tmp", "--no-test"]
+
+
+def test_split_build_flags_windows_quotes():
+    windows_flags = split_build_flags(r"""--croot "C:\some dir" --x 'a'""", posix=False)
+    assert windows_flags == ["--croot", r"C:\some dir", "--x", "a"]
+
+
+def test_parse_specs_invalid_build_flags(tmp_path):
+    specs_path = tmp_path / "specs.yaml"
+    specs_path.write_text(
+        dedent(
+            """
+            shared-config:
+              source-channels: [conda-forge]
+              destination-channel: my-channel
+              repo-cache-dir: cache
+              backend: conda
+            recipe-specs:
+              - name: abc
+                conda-build-flags: --extra-meta "note=unbalanced
+            """
+        )
+    )
+
+    with pytest.raises(SystemExit, match="conda-build-flags for recipe abc"):
+        parse_specs(_specs_args(specs_path))
+
+
+def test_write_result(tmp_path):
+    result_file = tmp_path / "result.yaml"
+    result_file.write_text("outdated")
+
+    write_result(str(result_file), {"built": [{"pakage_name": "abc"}]})
+
+    result = safe_yaml().load(result_file)
+    assert result["built"] == [{"pakage_name": "abc"}]
+    assert "last_updated" in result
+    assert [p.name for p in tmp_path.iterdir()] == ["result.yaml"]
+
+
+def test_main_writes_result_on_failed_build(mocker, tmp_path):
+    result_file = tmp_path / "out.yaml"
+    args = Namespace(
+        list=False,
+        logfile=str(result_file),
+        no_search_cache=False,
+        jobs=1,
+        token="",
+    )
+    recipe_specs = [{"name": "a"}, {"name": "b"}]
+    mocker.patch("publish_conda_stack.core.parse_cmdline_args", return_value=args)
+    mocker.patch(
+        "publish_conda_stack.core.parse_specs",
+        return_value=({"backend": "conda"}, recipe_specs),
+    )
+    mocker.patch("publish_conda_stack.core.search_channel", return_value={})
+    conda_build = mocker.MagicMock()
+    mocker.patch.dict(
+        sys.modules, {"conda_build": conda_build, "conda_build.api": conda_build.api}
+    )
+    # build_recipe reports failed builds with sys.exit()
+    mocker.patch(
+        "publish_conda_stack.core.build_and_upload_recipe",
+        side_effect=[
+            {"found": {"pakage_name": "a"}},
+            SystemExit("Failed to build package: b"),
+        ],
+    )
+
+    with pytest.raises(SystemExit):
+        main()
+
+    result = safe_yaml().load(result_file)
+    assert result["found"] == [{"pakage_name": "a"}]
+    assert [error["spec"] for error in result["errors"]] == [{"name": "b"}]
+    assert [p.name for p in tmp_path.iterdir()] == ["out.yaml"]
+
+
+def test_append_progress(tmp_path):
+    progress_file = tmp_path / "result.yaml.progress"
+
+    append_progress(str(progress_file), {"found": {"pakage_name": "abc"}})
+    append_progress(str(progress_file), {"built": {"pakage_name": "xyz"}})
+
+    documents = list(safe_yaml().load_all(progress_file))
+    assert documents[0]["found"] == {"pakage_name": "abc"}
+    assert documents[1]["built"] == {"pakage_name": "xyz"}
+    assert all("last_updated" in d for d in documents)
+
+
+RECIPE_SPECS = [{"name": "a"}, {"name": "b"}, {"name": "c"}, {"name": "d"}]
+
+
+@pytest.mark.parametrize(
+    "start_from,selected_recipes,expected",
+    [
+        ("", [], ["a", "b", "c", "d"]),
+        ("c", [], ["c", "d"]),
+        ("", ["d", "b"], ["b", "d"]),
+        ("b", ["a", "c"], ["c"]),
+    ],
+)
+def test_get_selected_specs(start_from, selected_recipes, expected):
+    args = Namespace(
+        start_from=start_from,
+        selected_recipes=selected_recipes,
+        recipe_specs_path="specs.yaml",
+    )
+    selected_specs = get_selected_specs(args, RECIPE_SPECS)
+    assert [spec["name"] for spec in selected_specs] == expected
+
+
+@pytest.mark.parametrize(
+    "start_from,selected_recipes,warns",
+    [
+        ("", ["b", "d"], False),
+        ("", ["d", "b"], True),
+        # recipes before start-from are dropped, but the order is fine
+        ("b", ["a", "c"], False),
+    ],
+)
+def test_get_selected_specs_order_warning(caplog, start_from, selected_recipes, warns):
+    args = Namespace(
+        start_from=start_from,
+        selected_recipes=selected_recipes,
+        recipe_specs_path="specs.yaml",
+    )
+    with caplog.at_level("INFO"):
+        get_selected_specs(args, RECIPE_SPECS)
+
+    assert any("WARNING" in message for message in caplog.messages) == warns
+
+
+@pytest.mark.parametrize(
+    "start_from,selected_recipes",
+    [
+        ("x", []),
+        ("", ["a", "x"]),
+    ],
+)
+def test_get_selected_specs_invalid(start_from, selected_recipes):
+    args = Namespace(
+        start_from=start_from,
+        selected_recipes=selected_recipes,
+        recipe_specs_path="specs.yaml",
+    )
+    with pytest.raises(SystemExit):
+        get_selected_specs(args, RECIPE_SPECS)
+
+
+def test_checkout_recipe_repo_new(mocker, tmp_path):
+    mocker.patch("subprocess.check_call")
+    mocker.patch("subprocess.call")
+
+    checkout_recipe_repo("https://github.com/owner/recipes.git", "v1", str(tmp_path))
+
+    repo_dir = os.path.join(tmp_path, "recipes")
+    assert subprocess.check_call.call_args_list[:3] == [
+        mocker.call(["git", "init", "--quiet", "recipes"], cwd=str(tmp_path)),
+        mocker.call(
+            ["git", "remote", "add", "owner", "https://github.com/owner/recipes.git"],
+            cwd=repo_dir,
+        ),
+        mocker.call(["git", "fetch", "--depth", "1", "owner", "v1"], cwd=repo_dir),
+    ]
+
+
+def test_checkout_recipe_repo_abbreviated_hash(mocker, tmp_path):
+    repo_dir = tmp_path / "recipes"
+    (repo_dir / ".git").mkdir(parents=True)
+    (repo_dir / ".git" / "shallow").touch()
+
+    def check_call(cmd, cwd=None):
+        # only full hashes, branches and tags can be fetched by name
+        if cmd[:4] == ["git", "fetch", "--depth", "1"]:
+            raise subprocess.CalledProcessError(128, cmd)
+
+    mocker.patch("subprocess.check_call", side_effect=check_call)
+    mocker.patch("subprocess.call")
+    mocker.patch("subprocess.run", return_value=mocker.Mock(stdout=""))
+
+    checkout_recipe_repo(
+        "https://github.com/owner/recipes.git", "1d9c5d3", str(tmp_path)
+    )
+
+    subprocess.check_call.assert_any_call(
         [
-            "conda",
-            "search",
-            "--json",
-            "--full-name",
-            "--override-channels",
-            "--channel",
-            "blah-forge",
-            "--channel",
-            "blah-forge/label/test",
-            "mypack",
-        ]
+            "git",
+            "fetch",
+            "--unshallow",
+            "--tags",
+            "owner",
+            "+refs/heads/*:refs/remotes/owner/*",
+        ],
+        cwd=str(repo_dir),
+    )
+    subprocess.check_call.assert_any_call(
+        ["git", "checkout", "--quiet", "1d9c5d3"], cwd=str(repo_dir)
     )
 
-    assert len(pkgs_found) == 1
-    assert pkgs_found[0][0] == c_pkg_names[0]
-    assert pkgs_found[0][1]
 
+def test_repo_checkout_shared_per_tag(mocker, tmp_path):
+    checkout = mocker.patch(
+        "publish_conda_stack.core.checkout_recipe_repo",
+        side_effect=lambda url, tag, cwd: os.path.join(cwd, "recipes"),
+    )
+    url = "https://github.com/owner/recipes.git"
+    repo_dir = os.path.join(tmp_path, "recipes")
+    shared = RepoCheckout()
+
+    with shared.use(url, "v1", str(tmp_path)) as first:
+        # same repo and tag again: nothing to do
+        with shared.use(url, "v1", str(tmp_path)) as second:
+            assert first == second == repo_dir
+        assert checkout.call_count == 1
+
+        # different tag: has to wait until the checkout isn't used anymore
+        entered = threading.Event()
+
+        def use_other_tag():
+            with shared.use(url, "v2", str(tmp_path)):
+                entered.set()
+
+        other = threading.Thread(target=use_other_tag)
+        other.start()
+        assert not entered.wait(0.1)
+        assert checkout.call_count == 1
+
+    other.join(timeout=5)
+    assert entered.is_set()
+    assert checkout.call_count == 2
+    checkout.assert_called_with(url, "v2", str(tmp_path))
+
+
+def test_print_recipe_list(caplog):
+    recipe_specs = [
+        {"name": "abc", "recipe-repo": "https://a/abc.git", "tag": "v1"},
+        {"name": "a-b-c-d", "recipe-repo": "https://a/abcd.git", "tag": "main"},
+    ]
+    with caplog.at_level("INFO"):
+        print_recipe_list(recipe_specs)
+
+    assert caplog.messages == [
+        "Recipes:\n"
+        "abc     : https://a/abc.git (v1)\n"
+        "a-b-c-d : https://a/abcd.git (main)"
+    ]
+
+
+def test_iter_recipe_names():
+    specs = dedent(
+        """
+        shared-config:
+          source-channels: [conda-forge]
+          name: not-a-recipe
+        recipe-specs:
+          - name: abc
+            recipe-repo: https://a/abc.git
+            environment:
+              name: not-a-recipe
+            build-on: [linux, {name: not-a-recipe}]
+          - recipe-repo: https://a/no-name.git
+          - name: a-b-c
+        other: [{name: not-a-recipe}]
+        """
+    )
+    assert list(iter_recipe_names(specs)) == ["abc", "a-b-c"]
+    assert list(iter_recipe_names("recipe-specs: []")) == []
+    assert list(iter_recipe_names("")) == []
 
-def test_check_already_exists_not_found(mocker):
-    c_pkg_names = (CCPkgName("mypack", "1.0", "py38_0_hblah"),)
-    shared_config = {
-        "destination-channel": "mock-channel",
-        "labels": ["test"],
-        "upload-channel": "blah-forge",
-    }
 
-    output = dedent(
+def test_iter_recipe_names_aliases():
+    specs = dedent(
         """
-        The following packages are not available from current channels:
+        base: &base
+          name: def
+          recipe-repo: https://a/def.git
+        recipe-specs:
+          - name: &n abc
+          - name: *n
+          - *base
+          - <<: *base
+            tag: v1
+        """
+    )
+    assert list(iter_recipe_names(specs)) == ["abc", "abc", "def", "def"]
+    assert list(iter_recipe_names("a: &s [{name: abc}]\nrecipe-specs: *s")) == ["abc"]
 
-          - ilastik-launch
 
-        Current channels:
+def test_write_result_failure_cleans_up(tmp_path):
+    result_file = tmp_path / "result.yaml"
+    result_file.write_text("previous")
 
-          - https://conda.anaconda.org/mock_channel/osx-64
-          - https://conda.anaconda.org/mock_channel/noarch
+    with pytest.raises(Exception):
+        write_result(str(result_file), {"errors": [{"error": object()}]})
 
-        To search for alternate channels that may provide the conda package you're
-        looking for, navigate to
+    assert result_file.read_text() == "previous"
+    assert [p.name for p in tmp_path.iterdir()] == ["result.yaml"]
 
-            https://anaconda.org
 
-        and use the search bar at the top of the page.
+def _specs_args(recipe_specs_path, **kwargs):
+    args = dict(
+        recipe_specs_path=str(recipe_specs_path),
+        selected_recipes=[],
+        start_from="",
+        label=[],
+        token="",
+    )
+    args.update(kwargs)
+    return Namespace(**args)
+
+
+@pytest.mark.parametrize("absolute", [True, False])
+def test_parse_specs_paths(tmp_path, absolute):
+    specs_dir = tmp_path / "specs"
+    specs_dir.mkdir()
+    cache_dir = tmp_path / "cache" if absolute else "../cache"
+    pins = tmp_path / "pins.yaml" if absolute else "../pins.yaml"
+    specs_path = specs_dir / "specs.yaml"
+    specs_path.write_text(
+        dedent(
+            f"""
+            shared-config:
+              source-channels: [conda-forge]
+              destination-channel: my-channel/label/test
+              repo-cache-dir: {cache_dir}
+              master-conda-build-config: {pins}
+              backend: conda
+            recipe-specs:
+              - name: abc
+            """
+        )
+    )
 
-        Traceback (most recent call last):
-          File "/Users/user/mambaforge/bin/publish-conda-stack", line 10, in <module>
-            sys.exit(main())
-          File "/Users/user/mambaforge/lib/python3.9/site-packages/publish_conda_stack/core.py", line 227, in main
-            raise e
-          File "/Users/user/mambaforge/lib/python3.9/site-packages/publish_conda_stack/core.py", line 223, in main
-            status = build_and_upload_recipe(spec, shared_config, conda_bld_config)
-          File "/Users/user/mambaforge/lib/python3.9/site-packages/publish_conda_stack/core.py", line 390, in build_and_upload_recipe
-            packages_found = check_already_exists(c_pkg_names, shared_config)
-          File "/Users/user/mambaforge/lib/python3.9/site-packages/publish_conda_stack/core.py", line 527, in check_already_exists
-            search_results_text = subprocess.check_output(search_cmd).decode()
-          File "/Users/user/mambaforge/lib/python3.9/subprocess.py", line 424, in check_output
-            return run(*popenargs, stdout=PIPE, timeout=timeout, check=True,
-          File "/Users/user/mambaforge/lib/python3.9/subprocess.py", line 528, in run
-            raise CalledProcessError(retcode, process.args,
-        subprocess.CalledProcessError: Command '['mamba', 'search', '--json', '--full-name', '--override-channels', '--channel', 'mock_channel', 'mypack']' returned non-zero exit status 1.
-    """
-    ).encode()
+    shared_config, selected_specs = parse_specs(_specs_args(specs_path))
 
-    mock_error = subprocess.CalledProcessError(
-        returncode=1,
-        cmd="['mamba', 'search', '--json', '--full-name', '--override-channels', '--channel', 'ilastik-forge', 'ilastik-launch']",
-        output=output,
+    assert shared_config["repo-cache-dir"] == tmp_path / "cache"
+    assert (tmp_path / "cache").is_dir()
+    assert shared_config["master-conda-build-config"] == str(tmp_path / "pins.yaml")
+    assert shared_config["conda-source-channel-list"] == ["-c", "conda-forge"]
+    assert shared_config["upload-channel"] == "my-channel"
+    assert shared_config["labels"] == ("test",)
+    assert [spec["name"] for spec in selected_specs] == ["abc"]
+
+
+@pytest.mark.parametrize(
+    "shared_config,environ,expected",
+    [
+        # not configured: left to conda-build
+        ({}, {}, None),
+        ({"cpu-count": 6}, {}, "6"),
+        # explicitly set in the environment
+        ({"cpu-count": 6}, {"CPU_COUNT": "2", "CMAKE_BUILD_PARALLEL_LEVEL": "2"}, "2"),
+    ],
+)
+def test_recipe_build_environment_cpu_count(
+    monkeypatch, shared_config, environ, expected
+):
+    monkeypatch.delenv("CPU_COUNT", raising=False)
+    monkeypatch.delenv("CMAKE_BUILD_PARALLEL_LEVEL", raising=False)
+    for key, value in environ.items():
+        monkeypatch.setenv(key, value)
+
+    build_environment = recipe_build_environment(
+        {"name": "abc", "environment": {"FOO": 1}}, shared_config
     )
 
-    subprocess_mock = mocker.Mock(side_effect=mock_error)
-    mocker.patch("subprocess.check_output", new=subprocess_mock)
+    assert build_environment["FOO"] == "1"
+    assert build_environment.get("CPU_COUNT") == expected
+    assert build_environment.get("CMAKE_BUILD_PARALLEL_LEVEL") == expected
 
-    pkgs_found = check_already_exists(c_pkg_names, shared_config)
 
-    subprocess_mock.assert_called_once_with(
-        [
-            "conda",
-            "search",
-            "--json",
-            "--full-name",
-            "--override-channels",
-            "--channel",
-            "blah-forge",
-            "--channel",
-            "blah-forge/label/test",
-            "mypack",
-        ]
+@pytest.mark.parametrize(
+    "remote_output,expected_remote",
+    [
+        (
+            "origin\thttps://github.com/owner/recipes.git (fetch)\n"
+            "origin\thttps://github.com/owner/recipes.git (push)\n",
+            "origin",
+        ),
+        (
+            "origin\thttps://github.com/other/recipes.git (fetch)\n"
+            "origin\thttps://github.com/other/recipes.git (push)\n"
+            "upstream  https://github.com/owner/recipes.git  (fetch)\r\n"
+            "upstream  https://github.com/owner/recipes.git  (push)\r\n",
+            "upstream",
+        ),
+    ],
+)
+def test_checkout_recipe_repo_existing_remote(
+    mocker, tmp_path, remote_output, expected_remote
+):
+    (tmp_path / "recipes").mkdir()
+    mocker.patch("subprocess.check_call")
+    mocker.patch("subprocess.call")
+    mocker.patch("subprocess.run", return_value=mocker.Mock(stdout=remote_output))
+
+    checkout_recipe_repo("https://github.com/owner/recipes.git", "v1", str(tmp_path))
+
+    subprocess.check_call.assert_any_call(
+        ["git", "fetch", "--depth", "1", expected_remote, "v1"],
+        cwd=os.path.join(tmp_path, "recipes"),
     )
 
-    assert len(pkgs_found) == 1
-    assert pkgs_found[0][0] == c_pkg_names[0]
-    assert not pkgs_found[0][1]
+
+@pytest.mark.parametrize("has_submodules", [True, False])
+def test_checkout_recipe_repo_submodules(mocker, tmp_path, has_submodules):
+    (tmp_path / "recipes").mkdir()
+    if has_submodules:
+        (tmp_path / "recipes" / ".gitmodules").touch()
+    mocker.patch("subprocess.check_call")
+    mocker.patch("subprocess.call")
+    mocker.patch("subprocess.run", return_value=mocker.Mock(stdout=""))
+
+    checkout_recipe_repo("https://github.com/owner/recipes.git", "v1", str(tmp_path))
+
+    git_commands = [c.args[0][1] for c in subprocess.check_call.call_args_list]
+    assert ("submodule" in git_commands) == has_submodules